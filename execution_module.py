@@ -21,6 +21,7 @@ Proxy Minion section of Salt's documentation.
 # Import Python Libs
 from __future__ import absolute_import
 import logging
+import hashlib
 import json
 import re
 import time
@@ -29,13 +30,13 @@ import subprocess
 # Import Salt Libs
 from salt.exceptions import SaltSystemExit
 
-# import http_session class from mod-rest-helper.py, for making REST calls to mod devices
+# REST calls to mod devices are made through the proxy: __proxy__['mod.rest_call']
 import sys
 import os
 
-# relative include of _utils directory- to find rest_helper
+# relative include of _utils directory- to find mod_utils
 sys.path.append(os.path.dirname(__file__))
-import rest_helper
+import mod_utils
 
 # This must be present or the Salt loader won't load this module.
 __proxyenabled__ = ['mod']
@@ -46,6 +47,9 @@ log = logging.getLogger(__name__)
 # Define the module's virtual name
 __virtualname__ = 'mod'
 
+# Lines of "ping" output which mean that the reply will not come
+PING_FAILURE_MARKERS = ['100% packet loss', 'Destination Host Unreachable', 'Request timed out']
+
 
 def __virtual__():
     """
@@ -79,13 +83,14 @@ def ping():
     ret = dict()
 
     try:
-        comp_name = __pillar__['node']['component']
+        mgmt_ip = __proxy__['mod.profile']().mgmt_ip
+        comp_str = '108 bytes from ' + mgmt_ip + ':'
         with __proxy__['mod.create_persistent_connection']() as mod_connection:
-            ret['message'] = mod_connection.exec_cmd('ping repeat 1 ' + __pillar__['pod']['mod'][comp_name]['mgmt']['ip'], context='ENABLE')
+            # stop reading at the reply or at the loss summary line
+            ret['message'] = mod_connection.exec_cmd('ping repeat 1 ' + mgmt_ip,
+                                                     context='ENABLE', expect=[comp_str] + PING_FAILURE_MARKERS)
         log.debug('ping result: ' + str(ret['message']))
 
-        comp_str = '108 bytes from ' + __pillar__['pod']['mod'][comp_name]['mgmt']['ip'] + ':'
-
         if comp_str in ret['message']:
             ret['out'] = True
             log.debug('good ping result found')
@@ -121,10 +126,21 @@ def restart(sleep_time=40):
         with __proxy__['mod.create_persistent_connection']() as mod_connection:
             ret['message'] = mod_connection.exec_cmd('restart', context='ENABLE')
         log.debug('mod.restart result: ' + str(ret['message']))
+        # the pooled sessions and the REST session are closed by the device restart
+        __proxy__['mod.reset_sessions']()
+        __proxy__['mod.invalidate_rest_session']()
+        # the configuration verified before the restart has to be verified again
+        _state_store().set('last_restart', time.time())
+        # the build may change after the restart
+        _forget_fact('build')
         ret['out'] = True
         ret['result'] = True
         log.debug('sleeping for {} seconds'.format(sleep_time))
-        time.sleep(sleep_time)
+        mod_utils.sleep(sleep_time, 'restart')
+        if sleep_time:
+            # log in as soon as the device accepts the connections again
+            # (in the proxy process only, a no-op with multiprocessing)
+            __proxy__['mod.prewarm']()
     except Exception as exception:
         ret['message'] = '*** modules.mod.restart(): execution failed due to "{0}"'.format(exception)
 
@@ -239,6 +255,73 @@ def set(config_command, check=""):
     return ret
 
 
+# =====================================
+# Run a batch of MOD CLI configuration commands
+def set_many(commands, stop_on_error=False):
+    """
+    Executes a list of CLI configuration commands in one CLI_CONFIG session
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.set_many '[{"cmd": "services clam active true", "chk": ""}, {"cmd": "ntp update-now"}]'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.set_many '["alerts destinations snmp [ ]", "ntp update-now"]' stop_on_error=True
+
+    Options:
+      * commands: List of {"cmd": <command>, "chk": <expected text in the output>}
+                  records (as in the JSON files) or plain command strings
+      * stop_on_error: Do not execute the rest of the commands after
+                       a failed one (default: False)
+
+    Returns:
+      * ret['message'] - list of the per-command results:
+        {'cmd': ..., 'chk': ..., 'out': True/False, 'message': <output>, 'seconds': <time>}
+        The commands which were not executed are not in the list.
+      * ret['out'] - True if all the commands succeeded
+
+    .. note::
+        The configuration commands are executed in CLI_CONFIG context
+
+    """
+    log.debug('mod.set_many called; {} commands; stop_on_error: {}'.format(len(commands), stop_on_error))
+    ret = dict()
+    ret['message'] = []
+    ret['out'] = True
+
+    try:
+        with __proxy__['mod.create_persistent_connection']() as mod_connection:
+            for record in commands:
+                if not isinstance(record, dict):
+                    record = {'cmd': record}
+                res = {'cmd': record['cmd'], 'chk': str(record.get('chk', ""))}
+                started = time.time()
+                try:
+                    output = mod_connection.exec_cmd(res['cmd'], context='CLI_CONFIG')
+                    log.debug('mod.set_many result: ' + str(output))
+                    res['message'] = output
+                    res['out'] = res['chk'] == "" or res['chk'].lower() in output.lower()
+                except Exception as exception:
+                    res['message'] = '*** modules.mod.set_many(): execution failed due to "{0}"'.format(exception)
+                    res['out'] = False
+                res['seconds'] = round(time.time() - started, 3)
+                ret['message'].append(res)
+
+                if not res['out']:
+                    log.debug('mismatch: ' + str(res))
+                    ret['out'] = False
+                    if stop_on_error:
+                        break
+    except Exception as exception:
+        # connection failed - none of the remaining commands were executed
+        ret['message'].append({'cmd': None, 'chk': "", 'out': False, 'seconds': 0,
+                               'message': '*** modules.mod.set_many(): execution failed due to "{0}"'.format(exception)})
+        log.debug('mod.set_many error: ' + str(exception))
+        ret['out'] = False
+
+    return ret
+
+
 # ========================================================
 # Set the name of the device
 def set_hostname(hostname=None):
@@ -283,7 +366,7 @@ def set_hostname(hostname=None):
 
 # ========================================================
 # Execute commands from .json file
-def exec_commands_from_file(json_fname):
+def exec_commands_from_file(json_fname, config=None):
     """
     Execute commands from .json file
 
@@ -295,9 +378,22 @@ def exec_commands_from_file(json_fname):
        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.exec_commands_from_file '/tmp/mod/mod-dpdev_add-mod.json'
        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.exec_commands_from_file '/tmp/mod/mod-dpdev_mod_config.json'
 
+    Options:
+      * json_fname: The JSON file with MOD commands
+      * config: {context: [records]} subset of the commands to execute instead
+                of the "config" key of the file, e.g. ret['failed'] of the
+                previous attempt (default: None - all commands of the file)
+
+    Returns:
+      * ret['failed'] - {context: [records]} of the commands which failed
+                        or did not match the check, to be retried
+      * ret['transient'] - False if a command raised an error which another
+                           attempt will not fix (only if a command raised)
+
     """
     log.debug('mod.exec_commands_from_file called json_fname: {}'.format(json_fname))
     ret = dict()
+    ret['failed'] = {}
     error_nums = 0
 
     # Open config.json file:
@@ -313,36 +409,54 @@ def exec_commands_from_file(json_fname):
     #         but Python 2.6 does not support multiple context expressions
     # Workaround: use nested statements
 
-    with open(json_fname, "r") as in_file:
-        with __proxy__['mod.create_persistent_connection']() as mod_connection:
-            conf = json.load(in_file)
-            # find the context in the "config" key
-            for context in conf['config']:
-                # loop for the list of commands (records) in the contex
-                for record in conf['config'][context]:
-                    # Get "chk:" value
-                    check = str(record['chk'])
-                    log.debug('chk value: ' + str(check))
-                    try:
-                        # execute the command in a given context
-                        log.debug('exec_cmd: ' + str(record['cmd']))
-                        res = mod_connection.exec_cmd(record['cmd'], context=context)
-                        log.debug('cmd result: ' + str(res))
-                        # check
-                        if check != "" and not check.lower() in res.lower():
-                            log.error("'{}' resulted in '{}' and did not match check: '{}'".format(record['cmd'], res, check))
-                            error_nums += 1
-                    except Exception as exception:
-                        log.error('{0}'.format(exception))
-                        ret['message'] = '*** modules.mod.exec_commands_from_file(): execution failed due to "{0}"'.format(exception)
-                        # log.debug(str(ret['message']))
-                        ret['out'] = False
-                        break
+    if config is None:
+        with open(json_fname, "r") as in_file:
+            config = json.load(in_file)['config']
+
+    # measured latencies for the dry-run cost estimates, see plan()
+    latencies = {}
+    started = time.time()
+    with __proxy__['mod.create_persistent_connection']() as mod_connection:
+        latencies['session'] = [time.time() - started]
+        # find the context in the "config" key
+        for context in config:
+            # loop for the list of commands (records) in the contex
+            records = config[context]
+            for idx, record in enumerate(records):
+                # Get "chk:" value
+                check = str(record['chk'])
+                log.debug('chk value: ' + str(check))
+                try:
+                    # execute the command in a given context
+                    log.debug('exec_cmd: ' + str(record['cmd']))
+                    started = time.time()
+                    matched, res = mod_connection.exec_cmd_check(record['cmd'], context, check)
+                    latencies.setdefault(context, []).append(time.time() - started)
+                    log.debug('cmd result: ' + str(res))
+                    # check
+                    if not matched:
+                        log.error("'{}' resulted in '{}' and did not match check: '{}'".format(record['cmd'], res, check))
+                        ret['failed'].setdefault(context, []).append(record)
+                        error_nums += 1
+                except Exception as exception:
+                    log.error('{0}'.format(exception))
+                    # the rest of the commands in this context were not executed
+                    ret['failed'].setdefault(context, []).extend(records[idx:])
+                    error_nums += len(records[idx:])
+                    ret['error'] = '*** modules.mod.exec_commands_from_file(): execution failed due to "{0}"'.format(exception)
+                    # e.g. the connection reset is worth another attempt, see mod_utils.is_transient
+                    ret['transient'] = ret.get('transient', True) and mod_utils.is_transient(exception)
+                    break
+
+    _record_latencies(latencies)
 
     log.debug('error_nums: ' + str(error_nums))
     if error_nums == 0:
         ret['message'] = "Success"
         ret['out'] = True
+    elif 'error' in ret:
+        ret['message'] = ret.pop('error')
+        ret['out'] = False
     else:
         ret['message'] = "Error in check of the results. Please, read the log file."
         ret['out'] = False
@@ -350,13 +464,254 @@ def exec_commands_from_file(json_fname):
     log.debug('return msg: ' + str(ret['message']))
     return ret
 
+# =========================================================
+#             S I N G L E - F L I G H T   C A L L S
+# =========================================================
+
+# Coalescing of the concurrent identical read-only calls, see _single_flight()
+_flights = None
+
+
+def _single_flight(name, args, func, *func_args):
+    """
+    Private function to run func(*func_args) once for the concurrent calls
+    of the same function with the same arguments: the calls arriving while
+    it is in flight (in this or another job process) get the same result
+    """
+    global _flights
+    if _flights is None:
+        _flights = mod_utils.SingleFlight(os.path.join(__opts__.get('cachedir', '/var/cache/salt/proxy'), 'mod', 'flight'))
+    key = json.dumps([mod_utils.device_name(__pillar__), name, args], sort_keys=True, default=str)
+    with mod_utils.span('function', 'mod.' + name):
+        return _flights.do(key, lambda: func(*func_args))
+
+
+def _mtime(fname):
+    """
+    Private function to get the modification time of the file (None if it does not exist)
+    """
+    try:
+        return os.path.getmtime(fname)
+    except OSError:
+        return None
+
+
+# =========================================================
+#                      F A C T S
+# =========================================================
+
+# =====================================
+# Persistent store of the device facts
+def _state_store():
+    """
+    Private function to get the persistent store of the device facts
+    """
+    return mod_utils.state_store(__opts__, __pillar__)
+
+
+# =====================================
+# Cached device facts
+def _save_fact(name, value):
+    """
+    Private function to save the device fact in the proxy cache and in the persistent store
+    """
+    __proxy__['mod.set_fact'](name, value)
+    _state_store().set(name, value)
+
+
+def _forget_fact(name):
+    """
+    Private function to remove the device fact from the proxy cache and the persistent store
+    """
+    __proxy__['mod.delete_fact'](name)
+    _state_store().delete(name)
+
+
+# Facts changed by the device events (records of the persistent store).
+# The job processes forget the fact in their own proxy cache only, the cache
+# of the proxy process (and of the next jobs forked from it) is checked here
+_FACT_RESET_BY = {'build': ('last_restart', 'last_upgrade')}
+
+
+def _cached_fact(name, max_age):
+    """
+    Private function to get the device fact from the proxy cache,
+    or from the persistent store (and put it back into the proxy cache).
+    The fact older than the last event changing it (see _FACT_RESET_BY) is not used.
+    Output:
+      * {'value': ..., 'timestamp': ..., 'age': ..., 'source': 'cache'|'store'} or None
+    """
+    store = _state_store()
+    reset = max([0] + [rec['timestamp'] for rec in (store.record(event) for event in _FACT_RESET_BY.get(name, ()))
+                       if rec is not None])
+
+    rec = __proxy__['mod.get_fact'](name, max_age)
+    if rec is not None and rec['timestamp'] > reset:
+        rec['source'] = 'cache'
+        return rec
+
+    rec = store.record(name)
+    if rec is not None and rec['age'] <= max_age and rec['timestamp'] > reset:
+        __proxy__['mod.set_fact'](name, rec['value'], rec['timestamp'])
+        rec['source'] = 'store'
+        return rec
+    return None
+
+
+# =====================================
+# Show the stored device facts
+def facts(key=None):
+    """
+    Show the device facts saved by the previous runs with their timestamps:
+    license_status, db_status, licenses, build, etc.
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.facts
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.facts license_status
+
+    """
+    log.debug('mod.facts called; key: ' + str(key))
+    ret = dict()
+
+    try:
+        store = _state_store()
+        if key is None:
+            ret['message'] = store.all()
+        else:
+            ret['message'] = store.record(key)
+        ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.facts(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+
+    return ret
+
+
+# =====================================
+# Measured command latencies
+def _record_latencies(latencies, alpha=0.2):
+    """
+    Private function to update the moving averages of the measured latencies
+    (seconds) saved as the "latency" fact: {'session': {'avg': ..., 'count': ...},
+    <context>: {'avg': ..., 'count': ...}}
+    Input:
+      * latencies - {'session': [seconds], <context>: [seconds]}
+    """
+    try:
+        store = _state_store()
+        stats = store.get('latency') or {}
+        for key, samples in latencies.items():
+            for sample in samples:
+                rec = stats.setdefault(key, {'avg': sample, 'count': 0})
+                rec['avg'] = rec['avg'] + alpha * (sample - rec['avg']) if rec['count'] else sample
+                rec['count'] += 1
+        store.set('latency', stats)
+    except Exception as exception:
+        log.debug('recording latencies failed: {0}'.format(exception))
+
+
+# =====================================
+# Dry-run plan of the commands
+def plan(json_fname, refresh=False, max_age=3600):
+    """
+    Dry-run planner: compute the commands of JSON file which would be sent
+    to the device, grouped by context, with the cost estimate
+
+    exec_commands_from_file sends all the commands of the file, so all of
+    them are planned and counted in the estimate. The CLI_CONFIG commands
+    are compared with the running-config snapshot (see mod.snapshot): the
+    commands which do not change the configuration are listed in
+    'unchanged', the commands without a recognized value (actions, string
+    values) in 'uncompared'.
+    The wall time is estimated from the latencies measured by
+    exec_commands_from_file (see mod.facts latency).
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.plan '/tmp/mod/mod-dpdev_config.json'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.plan '/tmp/mod/mod-dpdev_config.json' refresh=True
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.plan '/tmp/mod/mod-dpdev_config.json' max_age=600
+
+    Options:
+      * refresh: Take a new snapshot instead of using the last stored one (default: False)
+      * max_age: Seconds. Take a new snapshot if the last stored one is older
+                 (default: 3600, 0 or None - use the last snapshot of any age)
+
+    Returns:
+      * ret['message'] - {'commands': {context: [cmd, ...]},
+                          'unchanged': [cmd, ...],
+                          'uncompared': [cmd, ...],
+                          'sessions': N, 'mode_switches': N,
+                          'estimated_seconds': N,
+                          'snapshot': <timestamp of the snapshot>}
+    """
+    log.debug('mod.plan called, json_fname: ' + str(json_fname))
+    ret = dict()
+
+    try:
+        with open(json_fname, "r") as in_file:
+            config = json.load(in_file)['config']
+
+        snap = None if refresh else mod_utils.load_snapshot(__opts__, __pillar__)
+        if snap is not None and max_age and time.time() - snap.timestamp > float(max_age):
+            log.debug('mod.plan: the last snapshot is older than {0} seconds'.format(max_age))
+            snap = None
+        if snap is None:
+            snap = _capture_snapshot()
+            mod_utils.save_snapshot(__opts__, __pillar__, snap)
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.plan(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+        return ret
+
+    current = snap.as_dict()
+    commands = {}
+    unchanged = []
+    uncompared = []
+    for context in config:
+        for record in config[context]:
+            if context == 'CLI_CONFIG':
+                desired = mod_utils.desired_config([record['cmd']])
+                if not desired:
+                    uncompared.append(record['cmd'])
+                elif all(' '.join(current.get(path, '').split()) == ' '.join(value.split())
+                         for path, value in desired.items()):
+                    unchanged.append(record['cmd'])
+            commands.setdefault(context, []).append(record['cmd'])
+
+    # cost estimate: the connection, then one mode switch per context and one pooled
+    # session per context, or one session for all if the sessions are not kept
+    latency = _state_store().get('latency') or {}
+    default_latency = 1.0
+    seconds = 0.0
+    if commands:
+        seconds += latency.get('session', {}).get('avg', default_latency)
+        for context, cmds in commands.items():
+            seconds += len(cmds) * latency.get(context, {}).get('avg', default_latency)
+
+    ret['message'] = {'commands': commands,
+                      'unchanged': unchanged,
+                      'uncompared': uncompared,
+                      'sessions': len(commands) if __proxy__['mod.keeps_sessions']() else min(1, len(commands)),
+                      'mode_switches': len(commands),
+                      'estimated_seconds': round(seconds, 1),
+                      'snapshot': snap.timestamp}
+    ret['out'] = True
+    return ret
+
+
 # =========================================================
 #                    L I C E N S E S
 # =========================================================
 
 # =========================================================
 # Check if licenses was already loaded via REST call
-def check_licenses(host='127.0.0.1',username='super',password='12345'):
+def check_licenses(host='127.0.0.1',username='super',password='12345',max_age=0):
     """
     Check if licenses was already loaded
 
@@ -365,11 +720,23 @@ def check_licenses(host='127.0.0.1',username='super',password='12345'):
     .. code-block:: bash
 
        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.check_licenses
+       sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.check_licenses max_age=3600
+
+    Options:
+      * max_age: Seconds. Do not check the device if the licenses were
+                 found loaded less than max_age seconds ago (default: 0 - always check)
 
     """
     log.debug('mod.check_licenses called')
     ret = dict()
     err = ""
+
+    store = _state_store()
+    if max_age and store.get('license_status', max_age=float(max_age)) is True:
+        log.debug('licenses were loaded less than {} seconds ago'.format(max_age))
+        ret['message'] = "Licenses already loaded"
+        ret['out'] = True
+        return ret
     
     #check via REST call, instead of ConfD/SSH, APDS-509
     #theory being that issuing the command "show licenses" is causing stability problems with ConfD and back-end services
@@ -377,8 +744,11 @@ def check_licenses(host='127.0.0.1',username='super',password='12345'):
     cmd = "/opt/mod-utils/mod-licensing-rest.py -u {0} -p {1} -i {2} -a check".format(username, password, host)
     #cmd contains passwords
     #log.debug('subprocess: "{}"'.format(cmd))
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-    (res, err) = proc.communicate()
+    # queue behind the other license calls to the device
+    __proxy__['mod.throttle']('license')
+    with mod_utils.span('subprocess', 'mod-licensing-rest.py check'):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
+        (res, err) = proc.communicate()
     
     log.debug('result: ' + str(res))
     #if res['message']:
@@ -387,6 +757,7 @@ def check_licenses(host='127.0.0.1',username='super',password='12345'):
         if "\"valid\": true" in res:
             ret['message'] = "Licenses already loaded"
             ret['out'] = True
+            store.set('license_status', True)
         else:
             ret['message'] = "License is not installed"
             ret['out'] = False
@@ -399,6 +770,58 @@ def check_licenses(host='127.0.0.1',username='super',password='12345'):
     return ret
 
 
+# =========================================================
+# Get the dates of the installed licenses
+def get_license_dates():
+    """
+    Get the installed licenses with their dates (CLI "show licenses")
+
+    Usage:
+
+    .. code-block:: bash
+
+       sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.get_license_dates
+
+    .. note::
+       "show licenses" may cause stability problems with ConfD when
+       it is called in rapid succession. Use check_licenses to check
+       if the licenses are loaded.
+
+    """
+    log.debug('mod.get_license_dates called')
+    return get('licenses')
+
+
+# =========================================================
+# Wait until the loaded licenses are reported valid
+def wait_licenses_loaded(host='127.0.0.1',username='super',password='12345',timeout=None):
+    """
+    Poll check_licenses until the licenses are loaded or timeout seconds
+    passed. Used after the licenses were loaded instead of a fixed sleep;
+    the interval between the checks grows from 2 up to 10 seconds.
+
+    Usage:
+
+    .. code-block:: bash
+
+       sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.wait_licenses_loaded timeout=120
+
+    Options:
+      * timeout: Seconds (default: pod:mod:<comp>:retry:licenses_ready:deadline or 120)
+
+    """
+    log.debug('mod.wait_licenses_loaded called')
+    cfg = mod_utils.retry_policy(__pillar__, 'licenses_ready', deadline=120, base_delay=2, max_delay=10)
+    if timeout is None:
+        timeout = cfg.deadline
+
+    loaded, res = mod_utils.poll(lambda: check_licenses(host, username, password),
+                                 lambda res: 'already loaded' in res['message'],
+                                 timeout=timeout, interval=cfg.base_delay, max_interval=cfg.max_delay)
+    log.debug('licenses loaded: {}; result: {}'.format(loaded, res))
+    return res
+
+
 # =========================================================
 # Verify, load licenses, and verify again
 def load_licenses(json_fname,host='127.0.0.1',username='admin',password='admin'):
@@ -423,25 +846,40 @@ def load_licenses(json_fname,host='127.0.0.1',username='admin',password='admin')
     log.debug('result: ' + str(res))
 
     #if 'not loaded' in res['message'] or 'not installed' in res['message']:
-    if 'True' not in res:
+    if 'already loaded' not in res['message']:
         log.debug('license not loaded or not installed')
         # Loop - trying to load the licenses
-        for iter in range(3):
+        # Rapid succession of downloading license may cause instability,
+        # so the delays between the attempts are longer than the default ones
+        policy = mod_utils.retry_policy(__pillar__, 'licenses', attempts=3, base_delay=10, max_delay=60, deadline=600)
+        failed = None
+        for iter in policy:
+            if iter > 0:
+                # the previous load may have just been slow - do not download the license again
+                res = check_licenses(host,username,password)
+                if 'already loaded' in res['message']:
+                    ret['message'] = "Licenses loaded successfully"
+                    ret['out'] = True
+                    break
             # load license
             log.debug('running cmds: ' + str(json_fname))
-            res = exec_commands_from_file(json_fname)
+            res = policy.call(exec_commands_from_file, json_fname, config=failed)
             if res['out'] is True:
-                # check if licenses just loaded
-                res = check_licenses(host,username,password)
+                failed = None
+                # wait until the licenses just loaded are valid
+                res = wait_licenses_loaded(host,username,password)
                 log.debug('result: ' + str(res))
-                if 'True' in res:
-                #if 'already loaded' in res['message']:
+                if 'already loaded' in res['message']:
                     ret['message'] = "Licenses loaded successfully"
                     ret['out'] = True
                     break
             else:
+                # retry only the failed commands
+                failed = res['failed'] or None
                 ret['message'] = ret['message'] + "\n" + "Iter:{}".format(iter) + " ==> " + res['message']
                 log.debug("{}".format(ret['message']))
+                if not policy.should_retry(res):
+                    break
                 # end for
     else:
         log.debug('licenses are loaded and installed')
@@ -508,19 +946,26 @@ def add_mod(json_fname):
     res = check_mod()
     if 'not added' in res['message']:
         # Loop - trying to add MOD
-        for iter in range(3):
+        policy = mod_utils.retry_policy(__pillar__, 'add_mod', attempts=3, base_delay=2, deadline=300)
+        failed = None
+        for iter in policy:
             # load MOD
             log.debug('running cmds: ' + str(json_fname))
-            res = exec_commands_from_file(json_fname)
+            res = policy.call(exec_commands_from_file, json_fname, config=failed)
             if res['out'] is True:
+                failed = None
                 # check if MOD just added
-                res = check_ma()
+                res = check_mod()
                 if 'already added' in res['message']:
                     ret['message'] = "MOD added successfully"
                     ret['out'] = True
                     break
             else:
+                # retry only the failed commands
+                failed = res['failed'] or None
                 ret['message'] = ret['message'] + "\n" + "Iter:{}".format(iter) + " ==> " + res['message']
+                if not policy.should_retry(res):
+                    break
                 # end for iter
     else:
         ret['message'] = res['message']
@@ -551,16 +996,34 @@ def _get_commands_and_values(json_fname, cmd_types):
     log.debug('mod._get_commands_and_values called json_fname: {}; cmd_types: {}'.format(json_fname, cmd_types))
     cmd_dict = {}
 
-    pass
+    with open(json_fname, "r") as in_file:
+        config = json.load(in_file)['config']
+
+    # only the configuration commands set the values which can be verified
+    for record in config.get('CLI_CONFIG', []):
+        command = record['cmd']
+        if 'http' not in command:
+            command = command.replace('/', ' ')
+        tokens = command.split()
+        if not tokens or tokens[0] not in cmd_types:
+            continue
+        key, value = mod_utils.split_config_line(tokens)
+        if not value:
+            # actions like "ntp update-now" have nothing to verify
+            continue
+        # a path may repeat (list entries): expect all the values
+        cmd_dict[key] = cmd_dict[key] + ' ' + value if key in cmd_dict else key + ' ' + value
 
     return cmd_dict
 
 # =====================================
 # Verify the results of the extracted mod commands
-def _verify_commands(**cmd_dict):
+def _verify_commands(snapshot=None, **cmd_dict):
     """
     Private function to verify the results of the extracted mod commands
     Input:
+      * snapshot - ConfigSnapshot to verify against, instead of running
+                   "show config <cmd>" on the device for every command
       * cmd_dict - (key:value) of mod ConfD commands and expected results
     Output:
       * Result of the verification
@@ -587,8 +1050,12 @@ def _verify_commands(**cmd_dict):
         # remove double spaces
         new_record = ' '.join(new_record.split())
         # ===============================
-        # Execute the "<cmd>" command on mod node
-        cmd_result = get(cmd)
+        # Execute the "<cmd>" command on mod node (or look it up in the snapshot)
+        if snapshot is not None:
+            cmd_result = _snapshot_get(snapshot, cmd)
+        else:
+            with mod_utils.span('function', 'mod.get', command=cmd):
+                cmd_result = get(cmd)
         #       if cmd_result['out'] is True:
         if "syntax error" in cmd_result['message']:
             old_record = cmd + " " + "Element does not exist"
@@ -623,7 +1090,7 @@ def _verify_commands(**cmd_dict):
 
 # ========================================================
 # Verify the results of the mod commands (.json file)
-def verify(json_fname):
+def verify(json_fname, offline=False):
     """
     Verify the expected and real values configured by the commands in JSON file
 
@@ -632,9 +1099,22 @@ def verify(json_fname):
     .. code-block:: bash
 
         sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.verify '/tmp/mod/mod-dpdev_config.json'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.verify '/tmp/mod/mod-dpdev_config.json' offline=True
 
+    Options:
+      * offline: Verify against the last running-config snapshot (see mod.snapshot)
+                 instead of the device. The result is not saved as the verified
+                 configuration (default: False)
+
+    """
+    return _single_flight('verify', (json_fname, offline, _mtime(json_fname)), _verify, json_fname, offline)
+
+
+def _verify(json_fname, offline=False):
+    """
+    Private function to verify the commands of JSON file, see verify()
     """
-    log.debug('mod.verify called, json_fname: ' + str(json_fname))
+    log.debug('mod.verify called, json_fname: ' + str(json_fname) + '; offline: ' + str(offline))
 
     # mod command types
     cmd_types = ["alerts", "services", "snmp"]
@@ -666,8 +1146,17 @@ def verify(json_fname):
     # ===================================
     # Verify the results of the commands
     #
+    snapshot = None
+    if offline:
+        snapshot = mod_utils.load_snapshot(__opts__, __pillar__)
+        if snapshot is None:
+            ret['message'] = '*** modules.mod verify(): no running-config snapshot, run mod.snapshot first'
+            ret['out'] = False
+            return ret
+
     try:
-        ret = _verify_commands(**cmd_dict)
+        with mod_utils.span('function', '_verify_commands', commands=len(cmd_dict)):
+            ret = _verify_commands(snapshot=snapshot, **cmd_dict)
         log.debug('VERIFY: Old: {}, New: {}'.format(ret['old'], ret['new']))
         if ret['old'] or ret['new']:
             ret['message'] = "Failure"
@@ -677,6 +1166,9 @@ def verify(json_fname):
             ret.clear()
             ret['message'] = "Success"
             ret['out'] = True
+            # remember the verified configuration, see config_applied()
+            if not offline:
+                _save_config_hash(json_fname)
     except Exception as exception:
         ret['message'] = '*** modules.mod verify()._verify_commands: execution failed due to "{0}"'.format(exception)
         log.debug(str(ret['message']))
@@ -686,87 +1178,460 @@ def verify(json_fname):
 
 
 # =========================================================
-# Configure mod with pre and post verification
-def config(json_fname):
+#          R U N N I N G - C O N F I G   S N A P S H O T S
+# =========================================================
+
+# =====================================
+# Get running-config snapshot from the device
+def _capture_snapshot():
     """
-    Configure mod with pre and post verification
+    Private function to parse "show running-config" of the device into ConfigSnapshot
+    """
+    with __proxy__['mod.create_persistent_connection']() as mod_connection:
+        lines = list(mod_connection.exec_cmd_iter('show running-config', 'ENABLE'))
+    # big configurations are parsed in the process pool
+    return mod_utils.offload(__opts__, __pillar__, len(lines), mod_utils.parse_snapshot, lines)
+
+
+def _snapshot_get(snapshot, cmd):
+    """
+    Private function to answer "show config <cmd>" from the snapshot,
+    in the same format as get()
+    """
+    entries = snapshot.lookup(cmd)
+    if not entries:
+        return {'message': 'No entries found', 'out': True}
+    lines = [' '.join([path, value]).strip() for path, value in entries]
+    # _verify_commands joins the lines of the output without a separator
+    return {'message': ' \r\n'.join(lines), 'out': True}
+
+
+# =====================================
+# Take running-config snapshot
+def snapshot(save=True):
+    """
+    Take the snapshot of the running configuration of the device and save it
+    for the offline verification and diffing. The last 10 snapshots are kept in:
+      <cachedir>/mod/snapshots/<comp>-<pod>/
 
     Usage:
 
     .. code-block:: bash
 
-       sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.config '/tmp/mod/mod-dpdev_add-mod.json'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.snapshot
 
     """
-    log.debug('mod.config json_fname: {}'.format(json_fname))
+    log.debug('mod.snapshot called')
     ret = dict()
 
-    ret['message'] = ""
-    ret['out'] = False
-
-    # verify mod configuration
-    res = verify(json_fname)
-
-    if 'Success' not in res['message']:
-        # Loop - trying to configure mod
-        for iter in range(3):
-            # Configure mod from .json file
-            res = exec_commands_from_file(json_fname)
-            if res['out'] is True:
-                # verify mod again
-                res = verify(json_fname)
-                if 'Success' in res['message']:
-                    ret['message'] = "mod node configured successfully"
-                    ret['out'] = True
-                    break
-    else:
-        ret['message'] = res['message']
+    try:
+        snap = _capture_snapshot()
+        ret['message'] = {'entries': len(snap), 'timestamp': snap.timestamp}
+        if save:
+            ret['message']['file'] = mod_utils.save_snapshot(__opts__, __pillar__, snap)
         ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.snapshot(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
 
     return ret
 
 
 # =====================================
-# Shutdown the connection
-def shutdown():
-    """
-    Shutdown the connection to the mod proxy-minion.
-    For this proxy, shutdown is a no-op.
+# Look up the configuration in the last snapshot
+def snapshot_lookup(path):
     """
-    log.debug('mod proxy shutdown() called...')
+    Look up the configuration path (and its subtree) in the last
+    running-config snapshot, without touching the device
 
+    Usage:
 
-# =========================================================
-#                   D B   C O M M A N D S
-# =========================================================
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.snapshot_lookup 'interface 1:0'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.snapshot_lookup 'services clam'
 
-# =====================================
-# Check if DB has been downloaded
-def db_downloaded(targeted_vendor):
     """
-    Check if DB has been downloaded
+    log.debug('mod.snapshot_lookup called, path: ' + str(path))
+    ret = dict()
 
-    Parameters
-    ----------
-    targeted_vendor :
-        Targeted vendor to check
-        Vendor names: vendor
+    snap = mod_utils.load_snapshot(__opts__, __pillar__)
+    if snap is None:
+        ret['message'] = '*** modules.mod.snapshot_lookup(): no running-config snapshot, run mod.snapshot first'
+        ret['out'] = False
+        return ret
 
-    Returns
-    -------
-    If service downloaded successfully
-        ['out'] = True
-        ['massage'] = 'service <name> status ...' or 'Vendor ...'
-    If DB was not downloaded:
-        ['out'] = False
-        ['massage'] = ' No entries found'
+    # the values of a repeated path are joined with ", "
+    ret['message'] = mod_utils.ConfigSnapshot(snap.lookup(path)).as_dict()
+    ret['out'] = bool(ret['message'])
+    return ret
 
-    Usage
-    -----
+
+# =====================================
+# Configuration drift
+def drift(json_fname=None, save=True):
+    """
+    Detect the configuration drift: take a running-config snapshot and diff it
+      * against the last stored snapshot - added, removed and changed paths
+      * against the CLI_CONFIG commands of JSON file (if given) - missing and changed paths
+    The diff is made on the parsed snapshots, so the device is read only once.
+
+    Usage:
 
     .. code-block:: bash
 
-        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.db_downloaded 'vendor'
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.drift
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.drift '/tmp/mod/mod-dpdev_config.json'
+
+    Options:
+      * json_fname: The JSON file with the desired configuration commands (default: None)
+      * save: Save the new snapshot as the last one (default: True)
+
+    Returns:
+      * ret['out'] - True if there is no drift
+      * ret['message'] - {'since_last': {'added': ..., 'removed': ..., 'changed': ...},
+                          'desired': {'missing': ..., 'changed': ...,
+                                      'uncompared': [<commands without a recognized value>]},
+                          'previous': <timestamp of the last snapshot>}
+
+    """
+    log.debug('mod.drift called, json_fname: ' + str(json_fname))
+    ret = dict()
+
+    try:
+        previous = mod_utils.load_snapshot(__opts__, __pillar__)
+        current = _capture_snapshot()
+        since_last = None
+        if previous is not None:
+            since_last = mod_utils.offload(__opts__, __pillar__, len(previous) + len(current), mod_utils.diff_snapshots, previous, current)
+        ret['message'] = {'since_last': since_last,
+                          'previous': previous.timestamp if previous is not None else None}
+
+        if json_fname is not None:
+            with open(json_fname, "r") as in_file:
+                conf = json.load(in_file)
+            commands = [record['cmd'] for record in conf['config'].get('CLI_CONFIG', [])]
+            ret['message']['desired'] = mod_utils.offload(__opts__, __pillar__, len(current), mod_utils.diff_desired,
+                                                          current, mod_utils.desired_config(commands))
+            # not compared: no recognized value in the command
+            ret['message']['desired']['uncompared'] = mod_utils.uncompared_commands(commands)
+
+        if save:
+            ret['message']['file'] = mod_utils.save_snapshot(__opts__, __pillar__, current)
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.drift(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+        return ret
+
+    # the uncompared commands are reported, but they are not a drift
+    ret['out'] = not any(diff for section in ('since_last', 'desired')
+                         for key, diff in (ret['message'].get(section) or {}).items()
+                         if key != 'uncompared')
+    return ret
+
+
+# =====================================
+# Hash of the configuration commands (.json file)
+def config_hash(json_fname):
+    """
+    Calculate the hash of the configuration commands in JSON file.
+    Formatting and the order of the keys in the file do not change the hash.
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.config_hash '/tmp/mod/mod-dpdev_config.json'
+
+    """
+    log.debug('mod.config_hash called, json_fname: ' + str(json_fname))
+    ret = dict()
+
+    try:
+        with open(json_fname, "r") as in_file:
+            conf = json.load(in_file)
+        canonical = json.dumps(conf['config'], sort_keys=True, separators=(',', ':'))
+        ret['message'] = hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+        ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.config_hash(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+
+    return ret
+
+
+def _config_hash_key(json_fname):
+    """
+    Private function to get the key of the verified hash of the JSON file,
+    one record per file: config_hash:<absolute path>
+    """
+    return 'config_hash:' + os.path.abspath(json_fname)
+
+
+def _save_config_hash(json_fname):
+    """
+    Private function to save the hash of the verified configuration commands
+    """
+    res = config_hash(json_fname)
+    if res['out'] is True:
+        _state_store().set(_config_hash_key(json_fname), {'hash': res['message'], 'json_fname': json_fname})
+    else:
+        log.debug(str(res['message']))
+
+
+# =====================================
+# Check if the configuration has been already applied and verified
+def config_applied(json_fname):
+    """
+    Check, without touching the device, if the configuration commands in
+    JSON file have been already applied and verified:
+      * the hash of the commands matches the hash of the last verified
+        configuration of the same file
+      * the device has not been restarted or upgraded since the verification
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.config_applied '/tmp/mod/mod-dpdev_config.json'
+
+    """
+    log.debug('mod.config_applied called, json_fname: ' + str(json_fname))
+    ret = dict()
+    ret['out'] = False
+
+    res = config_hash(json_fname)
+    if res['out'] is not True:
+        ret['message'] = res['message']
+        return ret
+
+    store = _state_store()
+    verified = store.record(_config_hash_key(json_fname))
+    if verified is None or verified['value']['hash'] != res['message']:
+        ret['message'] = "Configuration {} has not been verified".format(res['message'])
+        return ret
+
+    for event in ('last_restart', 'last_upgrade'):
+        rec = store.record(event)
+        if rec is not None and rec['timestamp'] >= verified['timestamp']:
+            ret['message'] = "Device {} since the configuration was verified".format(
+                'restarted' if event == 'last_restart' else 'upgraded')
+            return ret
+
+    ret['message'] = "Configuration {} verified {:.0f} seconds ago".format(res['message'], verified['age'])
+    ret['out'] = True
+    return ret
+
+
+# =========================================================
+# Configure mod with pre and post verification
+def config(json_fname):
+    """
+    Configure mod with pre and post verification
+
+    Usage:
+
+    .. code-block:: bash
+
+       sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.config '/tmp/mod/mod-dpdev_add-mod.json'
+
+    """
+    log.debug('mod.config json_fname: {}'.format(json_fname))
+    ret = dict()
+
+    ret['message'] = ""
+    ret['out'] = False
+
+    # verify mod configuration
+    res = verify(json_fname)
+
+    if 'Success' not in res['message']:
+        # Loop - trying to configure mod
+        policy = mod_utils.retry_policy(__pillar__, 'config', attempts=3, base_delay=2, deadline=600)
+        failed = None
+        for iter in policy:
+            # Configure mod from .json file
+            res = policy.call(exec_commands_from_file, json_fname, config=failed)
+            if res['out'] is True:
+                failed = None
+                # verify mod again
+                res = verify(json_fname)
+                if 'Success' in res['message']:
+                    ret['message'] = "mod node configured successfully"
+                    ret['out'] = True
+                    break
+            else:
+                # retry only the failed commands
+                failed = res['failed'] or None
+                if not policy.should_retry(res):
+                    break
+    else:
+        ret['message'] = res['message']
+        ret['out'] = True
+
+    return ret
+
+
+# =====================================
+# Open the CLI sessions in advance
+def prewarm(contexts=None, timeout=None):
+    """
+    Open the pooled CLI sessions of the proxy in the background, so the
+    next commands find the sessions already logged in. Retries while the
+    device is not ready (e.g. after the restart).
+    Does nothing unless the proxy runs the jobs in its own process
+    ("multiprocessing: False" in the proxy minion configuration).
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.prewarm
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.prewarm contexts='[ENABLE]' timeout=600
+
+    Options:
+      * contexts: Contexts of the sessions (default: session_pool:prewarm:contexts or [ENABLE, CLI_CONFIG])
+      * timeout: Seconds to wait for the device (default: session_pool:prewarm:timeout or 300)
+
+    """
+    log.debug('mod.prewarm called; contexts: {}; timeout: {}'.format(contexts, timeout))
+    ret = dict()
+
+    try:
+        started = __proxy__['mod.prewarm'](contexts, timeout)
+        ret['message'] = "Pre-warm started" if started else "Pre-warm is disabled (session_pool, multiprocessing) or already running"
+        ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.prewarm(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+
+    return ret
+
+
+# =====================================
+# Profile a Salt function
+def profile(fun, *args, **kwargs):
+    """
+    Run a Salt function (e.g. state.sls or a mod function) with the profiling:
+    cProfile of the run and the timeline of the CLI/REST/subprocess calls,
+    logins and sleeps of the proxy are written into the profile directory
+    (pod:mod:<comp>:profile:dir, default: <cachedir>/mod/profile)
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.profile state.sls current_dp.comp.tools.configure
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.profile mod.verify '/tmp/mod/mod-dpdev_config.json'
+
+    Analyze the profile offline:
+
+    .. code-block:: bash
+
+        python -m pstats /var/cache/salt/proxy/mod/profile/state.sls-20171018-101500.prof
+
+    Returns:
+      * ret['message'] - the result of the function
+      * ret['profile'] - {'profile': <file>, 'timeline': <file>, 'otlp': <file>, 'trace_id': ...,
+                          'seconds': N, 'spans': {<kind>: {'count': N, 'seconds': N, 'self_seconds': N}}}
+
+    The spans are nested (state -> mod function -> exec_cmd -> cli/login/sleep),
+    the .otlp.json file can be loaded by the OpenTelemetry tools (OTLP/JSON).
+
+    .. note::
+        The profiling of every run of the mod states can be enabled by
+        the pod:mod:<comp>:profile:enabled pillar
+
+    """
+    log.debug('mod.profile called; fun: {}'.format(fun))
+    kwargs = dict((key, value) for key, value in kwargs.items() if not key.startswith('__'))
+
+    prof = mod_utils.start_profile(fun, mod_utils.profile_dir(__opts__, __pillar__))
+    if prof is None:
+        return {'message': '*** modules.mod.profile(): another profile is running', 'out': False}
+
+    ret = dict()
+    try:
+        ret['message'] = __salt__[fun](*args, **kwargs)
+        ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.profile(): {0} failed due to "{1}"'.format(fun, exception)
+        ret['out'] = False
+    finally:
+        ret['profile'] = mod_utils.stop_profile(prof)
+
+    return ret
+
+
+# =====================================
+# Proxy statistics
+def stats():
+    """
+    Show the state of the proxy helpers, e.g. the circuit breaker of the device
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.stats
+
+    """
+    log.debug('mod.stats called')
+    ret = dict()
+
+    try:
+        ret['message'] = __proxy__['mod.stats']()
+        if _flights is not None:
+            ret['message']['single_flight'] = _flights.stats()
+        ret['out'] = True
+    except Exception as exception:
+        ret['message'] = '*** modules.mod.stats(): execution failed due to "{0}"'.format(exception)
+        ret['out'] = False
+
+    return ret
+
+
+# =====================================
+# Shutdown the connection
+def shutdown():
+    """
+    Shutdown the connection to the mod proxy-minion.
+    For this proxy, shutdown is a no-op.
+    """
+    log.debug('mod proxy shutdown() called...')
+
+
+# =========================================================
+#                   D B   C O M M A N D S
+# =========================================================
+
+# =====================================
+# Check if DB has been downloaded
+def db_downloaded(targeted_vendor):
+    """
+    Check if DB has been downloaded
+
+    Parameters
+    ----------
+    targeted_vendor :
+        Targeted vendor to check
+        Vendor names: vendor
+
+    Returns
+    -------
+    If service downloaded successfully
+        ['out'] = True
+        ['massage'] = 'service <name> status ...' or 'Vendor ...'
+    If DB was not downloaded:
+        ['out'] = False
+        ['massage'] = ' No entries found'
+
+    Usage
+    -----
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.db_downloaded 'vendor'
 
     """
     log.debug('mod.db_downloaded called; targeted_vendor: ' + str(targeted_vendor))
@@ -795,7 +1660,8 @@ def db_downloaded(targeted_vendor):
     try:
         # execute the command in ENABLE context
         with __proxy__['mod.create_persistent_connection']() as mod_connection:
-            res = mod_connection.exec_cmd(cmd, context='ENABLE')
+            res = mod_connection.exec_cmd(cmd, context='ENABLE',
+                                          expect=[check_not_found, check_service_ok, check_clam_ok])
             log.debug('cmd result: ' + str(res))
     except Exception as exception:
         ret['message'] = '*** modules.mod.db_downloaded(): execution failed due to "{0}"'.format(exception)
@@ -807,7 +1673,7 @@ def db_downloaded(targeted_vendor):
     # check the result
     if check_not_found in res:
         ret['out'] = False
-    elif check_service_ok in res or check_vendor in res:
+    elif check_service_ok in res or check_clam_ok in res:
         ret['out'] = True
     else:
         log.error("'{}' resulted in '{}' and did not match known checks".format(cmd, res))
@@ -849,7 +1715,7 @@ def db_downloading(targeted_vendor):
     ret['message'] = ""
     ret['out'] = False
 
-    if targeted_vendor not in ['vendor]:
+    if targeted_vendor not in ['vendor']:
         ret['message'] = "Please, use one of the following vendor names as parameter:\n" \
                          + "[vendor]"
         log.debug('targeted_vendor not in approved list')
@@ -864,7 +1730,8 @@ def db_downloading(targeted_vendor):
     try:
         # execute the command in ENABLE context
         with __proxy__['mod.create_persistent_connection']() as mod_connection:
-            res = mod_connection.exec_cmd(cmd, context='ENABLE')
+            res = mod_connection.exec_cmd(cmd, context='ENABLE',
+                                          expect=[check_downloading, check_not_downloading])
             log.debug('cmd result: ' + str(res))
     except Exception as exception:
         log.error('{0}'.format(exception))
@@ -884,10 +1751,92 @@ def db_downloading(targeted_vendor):
     return ret
 
 
+# =====================================
+# Get the licensing information of the device
+def _get_licenses(max_age=0):
+    """
+    Private function to get the 'licenses' list of the device sys_info via REST.
+    The list saved by the previous call is used if it is less than max_age seconds old.
+    Raises an exception if the list cannot be retrieved.
+    """
+    if max_age:
+        # refreshed by the proxy in the background or saved by the previous run
+        rec = _cached_fact('licenses', float(max_age))
+        log.debug('cached licenses: ' + str(rec))
+        if rec is not None:
+            return rec['value']
+
+    # from the mod sys_info, extract the 'licenses' LIST
+    # (the cached REST session is retried once with a new one, see proxy rest_call)
+    __proxy__['mod.throttle']('license')
+    try:
+        output = __proxy__['mod.rest_call'](lambda mod: mod.sys_info()['licenses'], 'sys_info')
+        log.debug('output: ' + str(output))
+    except Exception as exception:
+        log.error('{0} ERROR retrieving licensing information via REST'.format(exception))
+        raise Exception('execution failed retrieving JSON licensing-object, is mod fully booted? ({0})'.format(exception))
+
+    _save_fact('licenses', output)
+    return output
+
+
+# =====================================
+# License table
+def license_table(vendors=None, thresholds=None, max_age=0):
+    """
+    Get all the licenses of the device as machine-readable records with
+    days remaining, validity and expiry threshold buckets, computed in one pass
+
+    Parameters
+    ----------
+    vendors :
+        Vendor names to report (defaults to None - all vendors)
+    thresholds :
+        Expiry threshold buckets, days (defaults to [7, 30, 90])
+    max_age :
+        Seconds. Use the licensing information saved by the previous run if it is
+        less than max_age seconds old, instead of the REST call to the device (defaults to 0)
+
+    Returns
+    -------
+        ['out'] = True if the licensing information was retrieved
+        ['message'] = list of records sorted by days_remaining:
+            {'vendor': 'BASE', 'valid': True, 'days_remaining': 25, 'expires': '2017-11-17',
+             'expired': False, 'bucket': 30, 'within': {'7': False, '30': True, '90': True}}
+
+    Usage
+    -----
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.license_table
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.license_table vendors='[BASE]' thresholds='[14, 60]'
+
+    """
+    return _single_flight('license_table', (vendors, thresholds, max_age), _license_table, vendors, thresholds, max_age)
+
+
+def _license_table(vendors=None, thresholds=None, max_age=0):
+    """
+    Private function to build the license table, see license_table()
+    """
+    log.debug('mod.license_table called; vendors: {}; thresholds: {}'.format(vendors, thresholds))
+
+    try:
+        output = _get_licenses(max_age)
+    except Exception as exception:
+        log.error('{0}'.format(exception))
+        return {'message': '*** modules.mod.license_table(): {0}'.format(exception), 'out': False}
+
+    records = mod_utils.offload(__opts__, __pillar__, len(output), mod_utils.license_records,
+                                output, thresholds or mod_utils.LICENSE_THRESHOLDS, vendors)
+    return {'message': records, 'out': True}
+
+
 # =====================================
 # Check if an AV Pattern DB has been downloaded, and if it will expire within <n> days
 #
-def db_expiry(targeted_vendor_list=None, days_from_now=0):
+def db_expiry(targeted_vendor_list=None, days_from_now=0, max_age=0):
     """
     Check if DB has been downloaded, and if it will expire within <n> days
 
@@ -900,6 +1849,9 @@ def db_expiry(targeted_vendor_list=None, days_from_now=0):
     days_from_now :
         checks if "days remaining" from license is greater than the value passed.  (defaults to 0)
         Returns False if the days remaining in the license is less than or equal to the days_from_now parameter
+    max_age :
+        Seconds. Use the licensing information saved by the previous run if it is
+        less than max_age seconds old, instead of the REST call to the device (defaults to 0)
 
     Returns
     -------
@@ -922,6 +1874,13 @@ def db_expiry(targeted_vendor_list=None, days_from_now=0):
         sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.db_expiry ['Vendor'] days_from_now='90'
         sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.db_expiry ['ALL'] days_from_now='90'
 
+    """
+    return _single_flight('db_expiry', (targeted_vendor_list, days_from_now, max_age), _db_expiry, targeted_vendor_list, days_from_now, max_age)
+
+
+def _db_expiry(targeted_vendor_list=None, days_from_now=0, max_age=0):
+    """
+    Private function to check the DB expiration, see db_expiry()
     """
     if targeted_vendor_list is None:
         targeted_vendor_list = ['BASE']
@@ -932,29 +1891,14 @@ def db_expiry(targeted_vendor_list=None, days_from_now=0):
     ret['message'] = ""
     ret['out'] = None  # None, not False
 
-    # create an object to interact with mod device
-    comp_name = __pillar__['node']['component']
-
     try:
-        mod = rest_helper.HttpSession(ip=__pillar__['pod']['mod'][comp_name]['mgmt']['ip'],
-                                       admin_password=__pillar__['pod']['mod'][comp_name]['deploy']['enablePassword'],
-                                       user=__pillar__['pod']['mod'][comp_name]['deploy']['userName'])
+        output = _get_licenses(max_age)
     except Exception as exception:
         log.error('{0}'.format(exception))
-        ret['message'] = '*** modules.mod.db_expiry(): execution failed instantiating rest_helper.HttpSession'
+        ret['message'] = '*** modules.mod.db_expiry(): {0}'.format(exception)
         ret['out'] = False
         return ret
 
-    mod.login()
-
-    # from the mod sys_info, extract the 'licenses' LIST
-    try:
-        output = mod.sys_info()['licenses']
-        log.debug('output: ' + str(output))
-    except Exception as exception:
-        log.error('{0} ERROR retrieving licensing information via REST'.format(exception))
-        return {'message': '*** modules.mod.db_expiry(): execution failed retrieving JSON licensing-object, is mod fully booted?', 'out': False}
-
     my_vendors = []
     valid_vendors = ['BASE', 'Vendor',]
 
@@ -971,35 +1915,32 @@ def db_expiry(targeted_vendor_list=None, days_from_now=0):
         ret['message'] = 'No valid vendor names were selected'
         return ret
 
-    pod_name = __pillar__['node']['pod']
-    tmp_db_status_fname = "/tmp/{}-{}-db-status".format(comp_name, pod_name)
-
-    with open(tmp_db_status_fname, "w") as db_status_file:
-        for license_dict in output:
-            for k, v in license_dict.items():
-                if k == 'vendor' and v in my_vendors:
-                    ret['message'] += '\nVendor: {}'.format(v)
-                    if license_dict['valid']:
-                        if int(license_dict['days_remaining']) > int(days_from_now):
-                            ret['message'] += ' Database "{}" days_remaining is: {}, which is greater than {} days from now'.format(v, int(
-                                license_dict['days_remaining']), days_from_now)
-                            if ret['out'] is None:
-                                ret['out'] = True
-                        else:
-                            ret['message'] += ' WARNING DATABASE "{}" LICENSE WILL EXPIRE WITHIN {} DAYS'.format(v, days_from_now)
-                            ret['out'] = False
-                    else:
-                        ret['message'] += ' Not Valid'
-                        ret['out'] = False
-        # Save the final status of loading of the DB
-        db_status_file.write(str(ret['out']))
+    # in the order of the licenses of the device, as the messages were before the license table
+    for record in mod_utils.offload(__opts__, __pillar__, len(output), mod_utils.license_records,
+                                    output, [days_from_now], my_vendors, None, False):
+        v = record['vendor']
+        ret['message'] += '\nVendor: {}'.format(v)
+        if not record['valid']:
+            ret['message'] += ' Not Valid'
+            ret['out'] = False
+        elif record['within'][str(int(days_from_now))]:
+            ret['message'] += ' WARNING DATABASE "{}" LICENSE WILL EXPIRE WITHIN {} DAYS'.format(v, days_from_now)
+            ret['out'] = False
+        else:
+            ret['message'] += ' Database "{}" days_remaining is: {}, which is greater than {} days from now'.format(
+                v, record['days_remaining'], days_from_now)
+            if ret['out'] is None:
+                ret['out'] = True
+
+    # Save the final status of loading of the DB
+    _state_store().set('db_status', ret['out'])
 
     return ret
 
 # =====================================
 # Image Upgrade
 #
-def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False):
+def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False, timeout = 90):
     """
     Retrieve a mod image (.bcsi) and load it, with optional reboot
 
@@ -1007,6 +1948,9 @@ def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False):
     ----------
     imageUrl :  The full URL to the .bcsi image. (default: None)
     buildNum :  The build number to boot to (default: 0)
+    timeout  :  Seconds to wait for the image download (default: 90)
+                If the download was started earlier by mod.image_prestage,
+                image_upgrade waits for it instead of starting a new one.
 
     Returns
     -------
@@ -1028,28 +1972,17 @@ def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False):
     log.debug('mod.image_upgrade called; imageUrl passed: {0}'.format(imageUrl))
     ret = dict()
 
-    # create an object to interact with mod device
-    comp_name = __pillar__['node']['component']
-
-    try:
-        mod = rest_helper.HttpSession(ip=__pillar__['pod']['mod'][comp_name]['mgmt']['ip'],
-                                       admin_password=__pillar__['pod']['mod'][comp_name]['deploy']['enable'],
-                                       user=__pillar__['pod']['mod'][comp_name]['deploy']['userName'])
-    except Exception as exception:
-        log.error('{0}'.format(exception))
-        ret['message'] = '*** modules.mod.image_upgrade(): execution failed instantiating rest_helper.HttpSession'
-        ret['out'] = False
-        return ret
-
-    mod.login()
-
     # from the mod system-images, iiterate over image-list, find which one is booted, extract releaseID
+    # (the cached REST session is retried once with a new one, see proxy rest_call)
     try:
-        ver = mod.version()
+        ver = __proxy__['mod.rest_call'](lambda mod: mod.version(), 'version')
         log.debug('mod version: ' + str(ver))
+        # the session has just answered - use it for the download
+        mod = __proxy__['mod.create_rest_session']()
     except Exception as exception:
         log.error('{0} ERROR retrieving system version via REST'.format(exception))
-        return {'message': '*** modules.mod.image_upgrade(): execution failed retrieving system version', 'out': False}
+        return {'message': '*** modules.mod.image_upgrade(): execution failed retrieving system version due to "{0}"'.format(exception),
+                'out': False}
 
     currentlyBooted = ver['build']
     if int(currentlyBooted) >= int(buildNum) and not forceImage:
@@ -1057,18 +1990,18 @@ def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False):
         log.debug(message)
         return {'message': '*** modules.mod.image_upgrade(): {0}'.format(message), 'out': False}
 
-    #send URL for mod to fetch
-    mod.retrieve_image(imageUrl)
+    #send URL for mod to fetch, unless the download has been already started by image_prestage()
+    prestaged = _state_store().get('image_prestage:{0}'.format(buildNum))
+    check = mod.retrieve_image_status()
+    if prestaged and prestaged['url'] == imageUrl and check['currentlyDownloading']:
+        log.debug('image download has been already started by image_prestage')
+    elif prestaged and prestaged['url'] == imageUrl and _default_image(mod) == int(buildNum):
+        log.debug('image has been already downloaded by image_prestage')
+    else:
+        mod.retrieve_image(imageUrl)
 
     #loop until image is retrieved, or timeout
-    stopLoop=False
-    count = 1
-    while not stopLoop and count < 10:
-        count += 1
-        time.sleep(10)
-        check = mod.retrieve_image_status()
-        if check['currentlyDownloading'] == False:
-            stopLoop = True
+    stopLoop, check = _wait_image_download(mod, buildNum, timeout)
 
     #did we time-out?
     if not stopLoop:
@@ -1084,10 +2017,256 @@ def image_upgrade(imageUrl = None, buildNum = 0, forceImage = False):
            break
 
     if int(sysImage['releaseId']) == int(buildNum):
+        # the configuration verified on the previous build has to be verified again
+        _state_store().set('last_upgrade', time.time())
+        # the build changes with the new image
+        _forget_fact('build')
+        # the device boots the new image: its REST session will be gone
+        __proxy__['mod.invalidate_rest_session']()
         return {'message': '{0}'.format(sysImage['releaseId']), 'out': True }
     else:
         return {'message': 'ERROR *** modules.mod.image_upgrade(): [{0}] The default image is still {1}'.format(check['reason'], sysImage['releaseId']), 'out': False }
 
+# =====================================
+# Default image of the device
+def _default_image(mod):
+    """
+    Private function to get the releaseId of the default image, or None
+    """
+    for sysImage in mod.system_images():
+        if sysImage['defaultImage']:
+            return int(sysImage['releaseId'])
+    return None
+
+
+# =====================================
+# Wait for the image download and stream its status
+def _wait_image_download(mod, buildNum, timeout=90, interval=10):
+    """
+    Private function to poll the image download status until the download
+    is finished or timed-out. Every status is sent to the event bus:
+      mod/image/download/<comp>-<pod>
+    so the progress of the rollout can be watched with "salt-run state.event".
+
+    Output:
+      * (finished, last status)
+    """
+    deadline = time.time() + float(timeout)
+    check = {}
+    while True:
+        mod_utils.sleep(min(interval, max(0, deadline - time.time())), 'image download')
+        check = mod.retrieve_image_status()
+        _send_download_event(buildNum, check)
+        if check['currentlyDownloading'] == False:
+            return True, check
+        if time.time() >= deadline:
+            return False, check
+
+
+def _send_download_event(buildNum, check):
+    """
+    Private function to send the image download status to the event bus
+    """
+    data = dict(check)
+    data['build'] = buildNum
+    data['device'] = mod_utils.device_name(__pillar__)
+    try:
+        __salt__['event.send']('mod/image/download/{0}'.format(data['device']), data)
+    except Exception as exception:
+        log.debug('sending image download event failed: {0}'.format(exception))
+
+
+# =====================================
+# Check the image on the ops node
+def image_check(imageUrl, buildNum, max_age=86400):
+    """
+    Check that the image exists on the ops node, get its size, ETag and
+    sha256 checksum (from the <imageUrl>.sha256 manifest, if any).
+    The result is cached per build number, so the check is made once
+    per build and not on every render of tools/image_upgrade.sls.
+
+    Parameters
+    ----------
+    imageUrl :  The full URL to the image
+    buildNum :  The build number of the image
+    max_age  :  Seconds to reuse the cached result (default: 86400)
+
+    Returns
+    -------
+        ['out'] = True if the image is available
+        ['message'] = {'url': ..., 'status': 200, 'size': ..., 'etag': ..., 'sha256': ...}
+
+    Usage
+    -----
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.image_check 'http://10.10.1.12/mod/mod-1234567.img' 1234567
+
+    """
+    log.debug('mod.image_check called; imageUrl: {0}; buildNum: {1}'.format(imageUrl, buildNum))
+    store = _state_store()
+    key = 'image:{0}'.format(buildNum)
+
+    cached = store.get(key, max_age=float(max_age))
+    if cached and cached['url'] == imageUrl and cached['status'] == 200:
+        log.debug('cached image info: ' + str(cached))
+        return {'message': cached, 'out': True}
+
+    try:
+        with mod_utils.span('rest', 'HEAD ' + imageUrl):
+            res = __salt__['http.query'](url=imageUrl, method='HEAD', status=True, headers=True)
+    except Exception as exception:
+        return {'message': '*** modules.mod.image_check(): execution failed due to "{0}"'.format(exception), 'out': False}
+
+    headers = dict((str(k).lower(), v) for k, v in (res.get('headers') or {}).items())
+    info = {'url': imageUrl,
+            'status': res.get('status'),
+            'size': int(headers['content-length']) if 'content-length' in headers else None,
+            'etag': headers.get('etag'),
+            'sha256': None}
+
+    if info['status'] == 200:
+        # optional manifest: "<sha256>  <file name>"
+        try:
+            manifest = __salt__['http.query'](url=imageUrl + '.sha256', status=True)
+            if manifest.get('status') == 200 and manifest.get('body'):
+                info['sha256'] = manifest['body'].split()[0]
+        except Exception as exception:
+            log.debug('no sha256 manifest for {0}: {1}'.format(imageUrl, exception))
+
+        if cached and cached['url'] == imageUrl and (cached['etag'], cached['size'], cached['sha256']) != \
+                (info['etag'], info['size'], info['sha256']):
+            log.warning('image {0} has changed on the ops node since the last check'.format(imageUrl))
+        store.set(key, info)
+
+    log.debug('image info: ' + str(info))
+    return {'message': info, 'out': info['status'] == 200}
+
+
+# =====================================
+# Pre-stage the image
+def image_prestage(imageUrl, buildNum):
+    """
+    Check the image on the ops node and start the download of the image
+    on the device without waiting for it, so that the following
+    image_upgrade only waits for the rest of the download.
+
+    Run it for many devices at once, e.g.:
+
+    .. code-block:: bash
+
+        sudo salt -L 'mod1.dpdev,mod2.dpdev' mod.image_prestage 'http://10.10.1.12/mod/mod-1234567.img' 1234567
+        sudo salt-run state.event 'mod/image/download/*'
+
+    Returns
+    -------
+        ['out'] = True if the download has been started or the image is already the default one
+    """
+    log.debug('mod.image_prestage called; imageUrl: {0}; buildNum: {1}'.format(imageUrl, buildNum))
+
+    res = image_check(imageUrl, buildNum)
+    if res['out'] is not True:
+        return {'message': '*** modules.mod.image_prestage(): image is not available: {0}'.format(res['message']), 'out': False}
+
+    def prestage(mod):
+        if _default_image(mod) == int(buildNum):
+            return None
+        check = mod.retrieve_image_status()
+        if not check['currentlyDownloading']:
+            mod.retrieve_image(imageUrl)
+            check = mod.retrieve_image_status()
+        return check
+
+    try:
+        check = __proxy__['mod.rest_call'](prestage, 'image_prestage')
+        if check is None:
+            return {'message': 'image {0} has been already downloaded'.format(buildNum), 'out': True}
+        _send_download_event(buildNum, check)
+    except Exception as exception:
+        log.error('{0}'.format(exception))
+        return {'message': '*** modules.mod.image_prestage(): execution failed due to "{0}"'.format(exception), 'out': False}
+
+    _state_store().set('image_prestage:{0}'.format(buildNum), {'url': imageUrl, 'size': res['message']['size']})
+    return {'message': 'download of image {0} started: {1}'.format(buildNum, check.get('downloadStatusMessage')), 'out': True}
+
+
+# =====================================
+# Image download status
+def image_download_status(buildNum=0, wait=0, interval=10):
+    """
+    Get the image download status of the device.
+    With wait > 0, poll the status every <interval> seconds until the
+    download is finished or <wait> seconds passed; every status is sent
+    to the event bus as mod/image/download/<comp>-<pod>.
+
+    Usage:
+
+    .. code-block:: bash
+
+        sudo salt 'mod1_zone1.us-central1.amazonaws.com' mod.image_download_status 1234567 wait=300
+
+    """
+    log.debug('mod.image_download_status called; buildNum: {0}; wait: {1}'.format(buildNum, wait))
+
+    try:
+        if int(wait) > 0:
+            finished, check = __proxy__['mod.rest_call'](
+                lambda mod: _wait_image_download(mod, buildNum, wait, interval), 'image_download_status')
+        else:
+            check = __proxy__['mod.rest_call'](lambda mod: mod.retrieve_image_status(), 'image_download_status')
+            _send_download_event(buildNum, check)
+            finished = check['currentlyDownloading'] == False
+    except Exception as exception:
+        log.error('{0}'.format(exception))
+        return {'message': '*** modules.mod.image_download_status(): execution failed due to "{0}"'.format(exception), 'out': False}
+
+    return {'message': check, 'out': finished}
+
+
+# ========================================================
+# Cached image build number
+#
+def cached_version(max_age=3600):
+    """
+    Get the MOD image build number from the fact cache of the proxy.
+    The device is asked (mod.version) only if the cached build number is
+    older than max_age seconds. It is safe to call during the rendering
+    of SLS files: it never raises and it does not touch the device when
+    the build number is cached.
+
+    Use mod.version for the authoritative (execution-time) checks.
+
+    Usage:
+
+    .. code-block:: bash
+
+        salt 'mod1_zone1.us-central1.amazonaws.com' mod.cached_version
+        salt 'mod1_zone1.us-central1.amazonaws.com' mod.cached_version max_age=60
+
+    .. code-block:: jinja
+
+        {% set current_build_num = salt['mod.cached_version']()['message'] %}
+
+    """
+    log.debug('mod.cached_version called; max_age: ' + str(max_age))
+
+    try:
+        rec = _cached_fact('build', float(max_age))
+        if rec is not None:
+            return {'message': rec['value'], 'out': True, 'age': round(rec['age'], 1), 'source': rec['source']}
+    except Exception as exception:
+        log.debug('mod.cached_version: fact cache failed: {0}'.format(exception))
+
+    try:
+        ret = version()
+    except Exception as exception:
+        ret = {'message': '*** modules.mod.cached_version(): execution failed due to "{0}"'.format(exception), 'out': False}
+    ret['age'] = 0
+    ret['source'] = 'device'
+    return ret
+
+
 # ========================================================
 # Extract the image build number
 #
@@ -1102,36 +2281,64 @@ def version():
         salt 'mod1_zone1.us-central1.amazonaws.com' mod.version
 
     """
-    log.debug('mod.version called')
-    ret = dict()
+    return _single_flight('version', (), _version)
 
-    # create an object to interact with mod device
-    comp_name = __pillar__['node']['component']
 
-    try:
-        mod = rest_helper.HttpSession(ip=__pillar__['pod']['mod'][comp_name]['mgmt']['ip'],
-                                       admin_password=__pillar__['pod']['mod'][comp_name]['deploy']['enablePassword'],
-                                       user=__pillar__['pod']['mod'][comp_name]['deploy']['userName'])
-    except Exception as exception:
-        log.error('{0}'.format(exception))
-        ret['message'] = '*** modules.mod.version(): execution failed instantiating rest_helper.HttpSession'
-        ret['out'] = False
-        return ret
-
-    mod.login()
+def _version():
+    """
+    Private function to get the build number via REST, see version()
+    """
+    log.debug('mod.version called')
+    ret = dict()
 
     # extract build from version object
+    # (the cached REST session is retried once with a new one, see proxy rest_call)
     try:
-        ver = mod.version()
+        ver = __proxy__['mod.rest_call'](lambda mod: mod.version(), 'version')
         log.debug('mod version-object: ' + str(ver))
     except Exception as exception:
         log.error('{0} ERROR retrieving system images via REST'.format(exception))
-        return {'message': '*** modules.mod.version(): execution failed retrieving JSON system_image list?', 'out': False}
+        ret['message'] = '*** modules.mod.version(): execution failed retrieving JSON system_image list due to "{0}"'.format(exception)
+        ret['out'] = False
+        return ret
 
     currentlyBooted = ver['build']
     if currentlyBooted:
+        _save_fact('build', '{0}'.format(currentlyBooted))
         return {'message': '{0}'.format(currentlyBooted), 'out': True}
     else:
         return {'message': '*** modules.mod.version(): execution failed', 'out': False}
 
+
+# ========================================================
+# Wait for the build after the restart
+#
+def wait_version(buildNum, timeout=600, interval=15):
+    """
+    Poll mod.version until the device runs the build or timeout seconds
+    passed. Used after the restart of the upgrade instead of a fixed sleep.
+
+    Usage:
+
+    .. code-block:: bash
+
+        salt 'mod1_zone1.us-central1.amazonaws.com' mod.wait_version 1234567
+        salt 'mod1_zone1.us-central1.amazonaws.com' mod.wait_version 1234567 timeout=900
+
+    Options:
+      * timeout: Seconds to wait for the build (default: 600)
+      * interval: Seconds between the checks (default: 15)
+
+    Returns:
+      * ret['out'] - True if the device runs the build
+    """
+    log.debug('mod.wait_version called; buildNum: {0}; timeout: {1}'.format(buildNum, timeout))
+
+    ready, res = mod_utils.poll(version, lambda res: res.get('out') is True and str(res['message']) == str(buildNum),
+                                timeout=float(timeout), interval=float(interval), max_interval=float(interval))
+    if ready:
+        return {'message': 'build {0} is running'.format(buildNum), 'out': True}
+    return {'message': '*** modules.mod.wait_version(): build {0} is not running after {1}s: {2}'.format(
+        buildNum, timeout, res['message']), 'out': False}
+
 # =========================================================
@@ -11,6 +11,12 @@ from __future__ import absolute_import
 import salt.utils
 import logging
 
+# relative include of _utils directory- to find mod_utils
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+import mod_utils
+
 __proxyenabled__ = ['mod']
 __virtualname__ = 'mod'
 
@@ -41,27 +47,27 @@ def os_family():
 
 
 def region():
-    region_name = __pillar__['node']['region']
+    region_name = mod_utils.device_profile(__pillar__).node['region']
     return {'region': region_name}
 
 
 def zone():
-    zone_name = __pillar__['node']['zone']
+    zone_name = mod_utils.device_profile(__pillar__).node['zone']
     return {'zone': zone_name}
 
 
 def dc():
-    dc_name = __pillar__['node']['dc']
+    dc_name = mod_utils.device_profile(__pillar__).node['dc']
     return {'dc': dc_name}
 
 
 def env():
-    env_name = __pillar__['node']['version']
+    env_name = mod_utils.device_profile(__pillar__).node['version']
     return {'env': env_name}
 
 
 def role():
-    role_name = __pillar__['node']['component_type']
+    role_name = mod_utils.device_profile(__pillar__).node['component_type']
     return {'role': role_name}
 
 
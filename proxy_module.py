@@ -9,7 +9,8 @@ Script: //_proxy/mod.py
 
 :maintainer:    Sergei Zaytsev <Sergei_Zaytsev@comp.com>
 :maturity:      new
-:depends:       cli_helper, paramiko v2.2.1 - NOT PROVIDED IN THIS EXAMPLE
+:depends:       cli_helper, rest_helper, paramiko v2.2.1 - NOT PROVIDED IN THIS EXAMPLE
+                mod_utils
 :platform:      all
 
 Define the pillars to configure the proxy-minion:
@@ -19,7 +20,8 @@ Define the pillars to configure the proxy-minion:
   proxy:
     proxytype: mod
 
-  Other connection parameters are defined from pillars through __pillar__ dunder:
+  Other connection parameters are defined from pillars through __pillar__ dunder
+  (resolved once per pillar revision into mod_utils.DeviceProfile):
     comp_name = __pillar__['node']['component']
     ipaddr:         __pillar__['pod']['mod'][comp_name]['mgmt']['ip']
     username:       __pillar__['pod']['mod'][comp_name]['deploy']['userName']
@@ -33,6 +35,71 @@ username
     (REQUIRED) username to login with
 password
     (REQUIRED) console password to use to login with
+fact_refresh
+    (OPTIONAL) refresh the device facts in the background, so the
+    grains and the execution module read them from memory:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            fact_refresh:
+              enabled: true
+              jitter: 0.1              # +/- fraction of the intervals
+              intervals:               # seconds; 0 disables the fact
+                version: 3600
+                build: 3600
+                mgmt_ip: 3600
+                licenses: 3600         # also license_table and licenses_valid
+                running_config_hash: 1800
+
+circuit_breaker
+    (OPTIONAL) fail fast while the device is unreachable; the state is
+    shared by the job processes (<cachedir>/mod/shared/<comp>-<pod>/):
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            circuit_breaker:
+              threshold: 3    # consecutive connect failures to open the circuit
+              cooldown: 60    # seconds to fail fast before the half-open probe
+
+session_pool
+    (OPTIONAL) keep the logged in CLI sessions between the jobs,
+    one per context (ENABLE, CLI_CONFIG). Requires "multiprocessing: False"
+    in the proxy minion configuration, otherwise every job opens and closes
+    its own sessions:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            session_pool:
+              max_idle: 2     # idle sessions kept open; 0 - close after every job
+              idle_ttl: 300   # seconds to keep an idle session
+              prewarm:        # open the sessions after init and restart; false - disable
+                              # (no-op with multiprocessing: True)
+                contexts: [ENABLE, CLI_CONFIG]
+                timeout: 300  # seconds to wait for the device
+                interval: 10  # seconds between the connection attempts
+rate_limits
+    (OPTIONAL) budgets of the command classes (show, config, license,
+    restart), the callers (also the job processes) queue behind them;
+    see mod_utils.RateLimiter:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            rate_limits:
+              license:
+                rate: 0.1     # calls per second
+                burst: 2
 
 .. note::
    Dependencies:
@@ -49,7 +116,18 @@ import salt
 from salt.utils.decorators import depends
 
 # Logging
+import hashlib
 import logging
+import random
+import threading
+import time
+
+# relative include of _utils directory- to find rest_helper and mod_utils
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+import rest_helper
+import mod_utils
 
 # Import cli_helper
 try:
@@ -66,6 +144,13 @@ __proxyenabled__ = ['mod']
 # so we can have persistent data across calls
 thisproxy = {}
 
+# Guards the cached REST session: [pid, lock], a forked process creates
+# its own lock (the inherited one may be locked by a thread of the parent)
+_rest_lock = [os.getpid(), threading.Lock()]
+
+# Guards the creation of the CLI session pool
+_pool_lock = threading.Lock()
+
 # Set up logging
 log = logging.getLogger(__file__)
 
@@ -113,61 +198,472 @@ def init(opts=None):
         log.debug('already initialized')
         return True
 
-    thisproxy['comp_name'] = __pillar__['node']['component']
-    thisproxy['comp_pillar'] = __pillar__['pod']['mod'][thisproxy['comp_name']]
+    _apply_profile(mod_utils.device_profile(__pillar__))
     log.info('Proxy.mod.init(): Running cli_helper.CLI for "{0}"'.format(thisproxy['comp_name']))
 
-    thisproxy['connection_kwargs'] = {
-        'ipaddr': thisproxy['comp_pillar']['mgmt']['ip'],
-        'username': thisproxy['comp_pillar']['deploy']['userName'],
-        'password': thisproxy['comp_pillar']['deploy']['consolePassword']
-    }
+    # fail fast while the device is unreachable
+    breaker_cfg = thisproxy['comp_pillar'].get('circuit_breaker') or {}
+    # (shared by the job processes, see mod_utils.SharedState)
+    thisproxy['breaker'] = mod_utils.CircuitBreaker(name=thisproxy['comp_name'],
+                                                    threshold=breaker_cfg.get('threshold', 3),
+                                                    cooldown=breaker_cfg.get('cooldown', 60),
+                                                    path=mod_utils.shared_state_path(__opts__, __pillar__,
+                                                                                     'circuit_breaker'))
+
+    # budgets of the command classes, see throttle()
+    # (shared by the job processes, see mod_utils.SharedState)
+    thisproxy['limiter'] = mod_utils.RateLimiter(thisproxy['comp_pillar'].get('rate_limits'),
+                                                 directory=mod_utils.shared_state_dir(__opts__, __pillar__))
+
+    # facts of the device shared by the jobs of this proxy, see get_fact()
+    thisproxy['facts'] = mod_utils.FactCache()
 
     thisproxy['initialized'] = True
+
+    # log in while nobody waits for the first command
+    if (thisproxy['comp_pillar'].get('session_pool') or {}).get('prewarm') is not False:
+        prewarm()
+
+    # optional background refresh of the facts
+    refresh_cfg = thisproxy['comp_pillar'].get('fact_refresh') or {}
+    if refresh_cfg.get('enabled', False):
+        thisproxy['refresher'] = FactRefresher(refresh_cfg.get('intervals'), refresh_cfg.get('jitter', 0.1))
+        thisproxy['refresher'].start()
+
     return True
 
 
+def _apply_profile(profile):
+    """
+    Set the connection parameters of the proxy from the DeviceProfile
+    """
+    thisproxy['profile'] = profile
+    thisproxy['comp_name'] = profile.comp_name
+    thisproxy['comp_pillar'] = profile.config
+
+    thisproxy['connection_kwargs'] = {
+        'ipaddr': profile.mgmt_ip,
+        'username': profile.username,
+        'password': profile.console_password
+    }
+
+    thisproxy['rest_kwargs'] = {
+        'ip': profile.mgmt_ip,
+        'admin_password': profile.enable_password,
+        'user': profile.username
+    }
+
+
+def profile():
+    """
+    The DeviceProfile of the device. It is rebuilt only when the pillar
+    of the device changes; the sessions opened with the old connection
+    parameters are dropped then.
+    """
+    current = mod_utils.device_profile(__pillar__)
+    previous = thisproxy.get('profile')
+    if current is not previous:
+        log.info('Proxy.mod: device profile changed: {!r}'.format(current))
+        _apply_profile(current)
+        if previous is not None and (previous.mgmt_ip, previous.username, previous.console_password,
+                                     previous.enable_password) != (current.mgmt_ip, current.username,
+                                                                   current.console_password, current.enable_password):
+            reset_sessions()
+            invalidate_rest_session()
+    return current
+
+
+def throttle(cmd_class):
+    """
+    Wait until the rate limiter of the device lets a call of the command
+    class (show, config, license, restart) go, see mod_utils.RateLimiter
+
+    :return: seconds waited
+    """
+    limiter = thisproxy.get('limiter')
+    if limiter is None or cmd_class is None:
+        return 0.0
+    try:
+        return limiter.acquire(cmd_class)
+    except mod_utils.RateLimitError as e:
+        log.warning('throttle "{}" rejected: {}'.format(cmd_class, e))
+        raise salt.exceptions.SaltException(str(e))
+
+
 def create_persistent_connection():
     """
     Create a PersistentConnection object in order to exec commands
 
     :return:
     """
+    profile()
     return PersistentConnection(thisproxy)
 
 
-class PersistentConnection(object):
+def _rest_guard():
+    """
+    The lock of the cached REST session in this process
+    """
+    if _rest_lock[0] != os.getpid():
+        _rest_lock[:] = [os.getpid(), threading.Lock()]
+    return _rest_lock[1]
+
+
+def create_rest_session(reuse=True):
+    """
+    Create a rest_helper.HttpSession object and login to the device.
+    The login goes through the circuit breaker of the device.
+
+    The logged in session is cached in the proxy and reused by the next
+    calls for rest_session_ttl seconds (component pillar, default: 300).
+    The session belongs to the process which logged in: a forked job
+    process does not use the session (and the sockets) of the parent.
+
+    :param reuse: return the cached session if it is not expired
+    :return: logged in rest_helper.HttpSession
+    """
+    ttl = profile().config.get('rest_session_ttl', 300)
+    with _rest_guard():
+        cached = thisproxy.get('rest_session')
+        if cached is not None and cached[2] != os.getpid():
+            # inherited from the parent process
+            log.debug('dropping the REST session of the process {0}'.format(cached[2]))
+            thisproxy.pop('rest_session', None)
+            cached = None
+        if reuse and cached is not None and time.time() - cached[1] < ttl:
+            return cached[0]
+
+    # the login is not guarded: the other threads keep using the cached session meanwhile
+    breaker = thisproxy.get('breaker')
+    if breaker is not None:
+        breaker.before_call()
+
+    try:
+        with mod_utils.span('login', 'rest'):
+            session = rest_helper.HttpSession(**thisproxy['rest_kwargs'])
+            session.login()
+    except Exception as e:
+        log.exception('create_rest_session failed: exception "{}"'.format(e))
+        if breaker is not None:
+            breaker.record_failure(e)
+        raise
+
+    if breaker is not None:
+        breaker.record_success()
+    with _rest_guard():
+        thisproxy['rest_session'] = (session, time.time(), os.getpid())
+    return session
+
+
+def invalidate_rest_session():
+    """
+    Drop the cached REST session, e.g. when a call failed with it
+    """
+    with _rest_guard():
+        thisproxy.pop('rest_session', None)
+
+
+def rest_call(func, name):
+    """
+    Call func(session) with the cached REST session and return its result.
+    The cached session may be dead on the device (e.g. after the restart),
+    so a failed call invalidates it and is retried once with a new session.
+
+    :param func: function(rest_helper.HttpSession)
+    :param name: name of the REST call span, e.g. 'version'
+    """
+    for reuse in (True, False):
+        try:
+            session = create_rest_session(reuse=reuse)
+        except Exception as e:
+            raise Exception('execution failed creating REST session due to "{0}"'.format(e))
+        try:
+            with mod_utils.span('rest', name, retry=not reuse):
+                return func(session)
+        except Exception as e:
+            invalidate_rest_session()
+            if not reuse:
+                raise
+            log.debug('REST call "{0}" failed: "{1}", retrying with a new session'.format(name, e))
+
+
+def _open_session():
+    """
+    Open a new CLI session to the device through the circuit breaker
+    """
+    breaker = thisproxy.get('breaker')
+    if breaker is not None:
+        try:
+            breaker.before_call()
+        except mod_utils.CircuitOpenError as e:
+            log.warning('PersistentConnection create connection rejected: {}'.format(e))
+            raise salt.exceptions.SaltException(str(e))
+
+    try:
+        with mod_utils.span('login', 'cli'):
+            session = cli_helper.CLI(**thisproxy['connection_kwargs'])
+    except Exception as e:
+        log.exception('PersistentConnection create connection failed: Exception constructing cli_helper.CLI due to "{}"'.format(e))
+        if breaker is not None:
+            breaker.record_failure(e)
+        raise salt.exceptions.SaltException(getattr(e, 'msg', str(e)))
+
+    if breaker is not None:
+        breaker.record_success()
+    return session
+
+
+def _close_session(session):
+    """
+    Exit the CLI and close the session
+    """
+    log.debug('closing mod_connection')
+    try:
+        session.command('', context='CLI_EXIT')
+        session.close()
+    except Exception as e:
+        # log it, but ok to kepp going
+        log.exception('PersistentConnection close connection failed: exception "{}"'.format(e))
+
+
+def _pooling():
+    """
+    True if the jobs run in the proxy process, so the idle sessions can be
+    kept between them. With "multiprocessing: True" (the default) every job
+    is a forked process which exits with its sessions.
+    """
+    return not __opts__.get('multiprocessing', True)
+
+
+def _session_pool():
+    """
+    The pool of the idle CLI sessions of the device (created on the first use
+    in every process; disabled - max_idle=0 - unless _pooling())
+    """
+    with _pool_lock:
+        pool = thisproxy.get('sessions')
+        if pool is not None and pool.pid != os.getpid():
+            # inherited from the parent process: its sessions are not ours to use or close
+            log.debug('dropping the session pool of the process {0}'.format(pool.pid))
+            pool = None
+        if pool is None:
+            pool_cfg = thisproxy.get('comp_pillar', {}).get('session_pool') or {}
+            pool = mod_utils.SessionPool(_open_session, _close_session,
+                                         max_idle=pool_cfg.get('max_idle', 2) if _pooling() else 0,
+                                         idle_ttl=pool_cfg.get('idle_ttl', 300))
+            thisproxy['sessions'] = pool
+        return pool
+
+
+def keeps_sessions():
+    """
+    True if the idle CLI sessions survive the jobs, so a PersistentConnection
+    opens a session per context; one session switching the mode otherwise
+    """
+    return _session_pool().max_idle > 0
+
+
+def reset_sessions():
+    """
+    Close the idle CLI sessions, e.g. after the device restart
+    """
+    _session_pool().clear()
+    return True
+
+
+def _warm_sessions(contexts):
+    """
+    Open the pooled sessions of the contexts, False if the device is not ready
     """
+    try:
+        _session_pool().warm(contexts, prime=lambda session, context: session.command('', context))
+        return True
+    except Exception as e:
+        log.debug('pre-warm of the sessions failed: {}'.format(e))
+        return False
+
+
+def prewarm(contexts=None, timeout=None, interval=None):
+    """
+    Open the pooled CLI sessions in the background, so the first command
+    finds a logged in session. The connection is retried every <interval>
+    seconds until the device accepts it or <timeout> seconds passed
+    (the device may still be booting).
+
+    Defaults: session_pool pillar "prewarm" (contexts: [ENABLE, CLI_CONFIG],
+    timeout: 300, interval: 10)
 
+    Runs only in the long-lived proxy process ("multiprocessing: False"):
+    a forked job process would exit with the thread and its sessions.
+
+    :return: False if the pool is disabled or a pre-warm is already running
+    """
+    if not _pooling():
+        log.debug('pre-warm skipped: the jobs run in the forked processes (multiprocessing)')
+        return False
+    pool = _session_pool()
+    cfg = (thisproxy.get('comp_pillar', {}).get('session_pool') or {}).get('prewarm') or {}
+    if not isinstance(cfg, dict):
+        cfg = {}
+    contexts = list(contexts or cfg.get('contexts') or ['ENABLE', 'CLI_CONFIG'])[:pool.max_idle]
+    if not contexts:
+        return False
+
+    with _pool_lock:
+        running = thisproxy.get('prewarm')
+        if running is not None and running.is_alive():
+            return False
+        thread = threading.Thread(target=mod_utils.poll, name='mod-session-prewarm',
+                                  args=(lambda: _warm_sessions(contexts), bool),
+                                  kwargs={'timeout': timeout or cfg.get('timeout', 300),
+                                          'interval': interval or cfg.get('interval', 10),
+                                          'max_interval': interval or cfg.get('interval', 10)})
+        thread.daemon = True
+        thread.start()
+        thisproxy['prewarm'] = thread
+    log.debug('pre-warming the sessions: {}'.format(contexts))
+    return True
+
+
+class PersistentConnection(object):
+    """
+    CLI connection to the device for the duration of the "with" block.
+
+    The sessions are taken from the session pool of the proxy, one per
+    context used in the block, and returned to the pool on exit; so the
+    commands do not switch the mode of a session back and forth and the
+    next block finds the sessions already logged in.
+    Without the idle sessions (max_idle=0, e.g. under multiprocessing) the
+    block uses one session and switches its mode: a login costs more than
+    a mode switch.
     """
     def __init__(self, proxy_cfg):
         self.proxy_cfg = proxy_cfg
+        self.pool = _session_pool()
+        self.sessions = {}
 
     def __enter__(self):
+        # the sessions are taken on the first command of every context,
+        # new connections go through the circuit breaker (see _open_session)
+        return self
+
+    def _session(self, context):
+        """
+        Session for the context: the one already used in this block for it,
+        an idle one left in this context, or a new one
+        """
+        entry = self.sessions.get(context)
+        if entry is None and self.sessions and not self.pool.max_idle:
+            # the session would not survive the block - switch the mode of the one we have
+            entry = self.sessions.pop(list(self.sessions)[0])
+            self.sessions[context] = entry
+        if entry is None:
+            entry = self.pool.acquire(context)
+            self.sessions[context] = entry
+        if entry.context not in (None, context):
+            self.pool.switched()
+        entry.context = context
+        return entry
+
+    def _call(self, method, command, context):
+        throttle(mod_utils.command_class(command, context))
+        entry = self._session(context)
         try:
-            self.mod_connection = cli_helper.CLI(**self.proxy_cfg['connection_kwargs'])
-            return self
+            with mod_utils.span('cli', command, context=context):
+                return getattr(entry.session, method)(command, context)
         except Exception as e:
-            log.exception('PersistentConnection create connection failed: Exception constructing cli_helper.CLI due to "{}"'.format(e))
-            raise salt.exceptions.SaltException(e.msg)
-
-    def exec_cmd(self, command, context):
+            entry.broken = True
+            del self.sessions[context]
+            self.pool.release(entry)
+            if not entry.reused:
+                raise e
+            # the idle session may have been closed by the device - retry with a new one
+            log.debug('pooled session failed: "{}", retrying with a new session'.format(e))
+            entry = self._session(context)
+            try:
+                with mod_utils.span('cli', command, context=context, retry=True):
+                    return getattr(entry.session, method)(command, context)
+            except Exception:
+                entry.broken = True
+                raise
+
+    def exec_cmd(self, command, context, expect=None):
         """
         Execute command on the device in a given context
+
+        expect - list of the success/failure markers (text or compiled regular
+                 expressions): stop reading the output at the first line
+                 matching one of them and return the output read so far
+                 (the early stop needs CLI.command_iter, see exec_cmd_iter)
+        """
+        with mod_utils.span('function', 'PersistentConnection.exec_cmd', command=command):
+            if expect:
+                lines = self.exec_cmd_iter(command, context)
+                try:
+                    return mod_utils.read_until(lines, expect)[1]
+                finally:
+                    lines.close()
+            return self._call('command', command, context)
+
+    def exec_cmd_iter(self, command, context):
         """
+        Execute command on the device in a given context and yield the output
+        lines as they arrive. Stop iterating (or close the generator) to stop
+        reading the output.
+
+        cli_helper versions without the streaming API (CLI.command_iter)
+        read the whole output first, the lines are split lazily then
+        (no early stop).
+
+        The session of a stream stopped before its end (or failed) may still
+        have unread output: it is closed instead of being used by the next
+        command.
+        """
+        entry = self._session(context)
+        streaming = hasattr(entry.session, 'command_iter')
+        if streaming:
+            chunks = self._call('command_iter', command, context)
+        else:
+            chunks = self._call('command', command, context)
+        finished = False
         try:
-            return self.mod_connection.command(command, context)
-        except Exception as e:
-            raise e
+            for line in mod_utils.iter_lines(chunks):
+                yield line
+            finished = True
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if streaming and not finished:
+                self._discard(context)
+
+    def _discard(self, context):
+        """
+        Close the session of the context, the next command opens a new one
+        """
+        entry = self.sessions.pop(context, None)
+        if entry is not None:
+            entry.broken = True
+            self.pool.release(entry)
 
-    def __exit__(self, exc_type, exc_value, traceback):
-        log.debug('closing mod_connection')
+    def exec_cmd_check(self, command, context, check):
+        """
+        Execute command on the device in a given context and search the check
+        text (case-insensitive) in the output, up to the first matching line
+        Output:
+          * (True, matching line) or (False, the last lines of the output)
+        """
+        if check == "":
+            return True, self.exec_cmd(command, context)
+        lines = self.exec_cmd_iter(command, context)
         try:
-            self.mod_connection.command('', context='CLI_EXIT')
-            self.mod_connection.close()
-        except Exception as e:
-            # log it, but ok to kepp going
-            log.exception('PersistentConnection close connection failed: exception "{}"'.format(e))
+            return mod_utils.find_in_lines(lines, check)
+        finally:
+            lines.close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for entry in self.sessions.values():
+            self.pool.release(entry)
+        self.sessions = {}
 
 
 # =====================================
@@ -238,8 +734,12 @@ def version():
     """
 
     log.debug('mod proxy version called')
+    return {'version': _cached('version', _fetch_version)}
+
+
+def _fetch_version():
     with create_persistent_connection() as conn:
-        return {'version': conn.exec_cmd('show version', context='CLI')}
+        return conn.exec_cmd('show version', context='CLI')
 
 
 # =====================================
@@ -250,6 +750,10 @@ def mgmt_ip():
     """
 
     log.debug('mod proxy mgmt_ip called')
+    return _cached('mgmt_ip', _fetch_mgmt_ip)
+
+
+def _fetch_mgmt_ip():
     with create_persistent_connection() as conn:
         res = conn.exec_cmd('show running-config ip-address', context='CLI')
         # expected result:
@@ -265,6 +769,171 @@ def mgmt_ip():
         return "N/A"
 
 
+# =====================================
+# Device facts cache
+def get_fact(name, max_age=None):
+    """
+    Get the cached device fact: {'value': ..., 'timestamp': ..., 'age': ...}
+    or None if the fact is not cached or older than max_age seconds
+    """
+    if 'facts' not in thisproxy:
+        return None
+    rec = thisproxy['facts'].record(name)
+    if rec is None or (max_age is not None and rec['age'] > max_age):
+        return None
+    return rec
+
+
+def set_fact(name, value, timestamp=None):
+    """
+    Cache the device fact
+    """
+    if 'facts' in thisproxy:
+        thisproxy['facts'].set(name, value, timestamp)
+
+
+def delete_fact(name):
+    """
+    Remove the device fact from the cache
+    """
+    if 'facts' in thisproxy:
+        thisproxy['facts'].delete(name)
+
+
+def _cached(name, fetch):
+    """
+    Serve the fact from the cache while the background refresher keeps it fresh,
+    otherwise get it from the device
+    """
+    refresher = thisproxy.get('refresher')
+    if refresher is not None:
+        rec = get_fact(name, max_age=refresher.max_age(name))
+        if rec is not None:
+            return rec['value']
+    value = fetch()
+    set_fact(name, value)
+    return value
+
+
+# =====================================
+# Background refresh of the device facts
+def _fetch_build():
+    return '{0}'.format(rest_call(lambda session: session.version()['build'], 'version'))
+
+
+def _fetch_licenses():
+    throttle('license')
+    licenses = rest_call(lambda session: session.sys_info()['licenses'], 'sys_info')
+    # the license table and the validity of all the licenses are derived from
+    # the same REST call (not the vendor/days specific db_status of mod.db_expiry)
+    records = mod_utils.license_records(licenses)
+    set_fact('license_table', records)
+    set_fact('licenses_valid', all(rec['valid'] and not rec['expired'] for rec in records))
+    return licenses
+
+
+def _fetch_running_config_hash():
+    with create_persistent_connection() as conn:
+        res = conn.exec_cmd('show running-config', context='CLI')
+    return hashlib.sha256(res.encode('utf-8')).hexdigest()
+
+
+class FactRefresher(threading.Thread):
+    """
+    Daemon thread which refreshes the device facts at the configured
+    intervals and writes them into the fact cache of the proxy.
+    The intervals get a random +/- jitter, and the first refresh of every
+    fact is delayed randomly, so the proxies of the fleet do not hit
+    their devices at the same time.
+    """
+    DEFAULT_INTERVALS = {'version': 3600,
+                         'build': 3600,
+                         'mgmt_ip': 3600,
+                         'licenses': 3600,
+                         'running_config_hash': 1800}
+
+    FETCHERS = {'version': _fetch_version,
+                'build': _fetch_build,
+                'mgmt_ip': _fetch_mgmt_ip,
+                # license_table and licenses_valid are by-products of the licenses
+                'licenses': _fetch_licenses,
+                'running_config_hash': _fetch_running_config_hash}
+
+    def __init__(self, intervals=None, jitter=0.1):
+        super(FactRefresher, self).__init__(name='mod-fact-refresher')
+        self.daemon = True
+        self.intervals = dict(self.DEFAULT_INTERVALS)
+        self.intervals.update(intervals or {})
+        self.intervals = dict((name, float(interval)) for name, interval in self.intervals.items()
+                              if interval and name in self.FETCHERS)
+        self.jitter = float(jitter)
+        self.stopped = threading.Event()
+        self.errors = {}
+        now = time.time()
+        self.due = dict((name, now + random.uniform(0, interval * self.jitter))
+                        for name, interval in self.intervals.items())
+
+    def max_age(self, name):
+        """
+        Max age of the fact served from the cache: the fact is considered stale
+        if the refresher missed two of its refreshes (e.g. the device is down)
+        """
+        if name not in self.intervals:
+            return 0
+        return 2 * self.intervals[name] * (1 + self.jitter)
+
+    def refresh(self, name):
+        try:
+            value = self.FETCHERS[name]()
+            set_fact(name, value)
+            self.errors.pop(name, None)
+        except Exception as e:
+            # the device may be down - the circuit breaker keeps it cheap
+            log.debug('mod fact refresher: refresh of "{}" failed: {}'.format(name, e))
+            self.errors[name] = str(e)
+
+    def run(self):
+        log.info('mod fact refresher started: {}'.format(self.intervals))
+        while not self.stopped.is_set():
+            name = min(self.due, key=self.due.get)
+            delay = self.due[name] - time.time()
+            if delay > 0:
+                self.stopped.wait(delay)
+                continue
+            self.refresh(name)
+            interval = self.intervals[name]
+            self.due[name] = time.time() + interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def stop(self):
+        self.stopped.set()
+
+    def stats(self):
+        now = time.time()
+        return {'intervals': self.intervals,
+                'next_refresh_in': dict((name, round(due - now, 1)) for name, due in self.due.items()),
+                'errors': dict(self.errors)}
+
+
+# =====================================
+# Get proxy statistics
+def stats():
+    """
+    Get the state of the proxy helpers, e.g. the circuit breaker
+    """
+    res = dict()
+    if 'breaker' in thisproxy:
+        res['circuit_breaker'] = thisproxy['breaker'].stats()
+    if 'refresher' in thisproxy:
+        res['fact_refresher'] = thisproxy['refresher'].stats()
+    if 'sessions' in thisproxy:
+        res['session_pool'] = thisproxy['sessions'].stats()
+    if 'limiter' in thisproxy:
+        res['rate_limiter'] = thisproxy['limiter'].stats()
+    if mod_utils.process_pool_stats() is not None:
+        res['process_pool'] = mod_utils.process_pool_stats()
+    return res
+
+
 # =====================================
 # Close MOD connection
 def shutdown(opts=None):
@@ -276,5 +945,11 @@ def shutdown(opts=None):
 
     log.info('Proxy.mod.shutdown(): Proxy module {0} shutting down!'.format(opts['id']))
 
-    # all connections use PersistentConnection which guarantees connection all closed on class exit
+    if 'refresher' in thisproxy:
+        thisproxy['refresher'].stop()
+
+    # the idle sessions of the pool, PersistentConnection returns the used ones on class exit
+    if 'sessions' in thisproxy:
+        thisproxy['sessions'].clear()
+    mod_utils.close_process_pool()
     return True
@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+MOD runner module.
+Orchestrates operations across many MOD proxy-minions from the master.
+
+Script: //_runners/mod.py
+
+.. versionadded:: 2017.7.0
+
+:maturity:      new
+:depends:       mod.py execution module on the proxy-minions
+:platform:      all
+
+"""
+
+# Import Python libs
+from __future__ import absolute_import
+import csv
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Import Salt libs
+import salt.client
+import salt.utils.minions
+
+# Logging
+log = logging.getLogger(__name__)
+
+# Define the module's virtual name
+__virtualname__ = 'mod'
+
+
+def __virtual__():
+    return __virtualname__
+
+
+# =====================================
+# Helpers
+def _progress(message):
+    """
+    Private function to show the progress of the runner
+    """
+    log.info(message)
+    try:
+        __jid_event__.fire_event({'message': message}, 'progress')
+    except NameError:
+        pass
+
+
+def _cmd(tgt, fun, arg=(), tgt_type='glob', timeout=None):
+    """
+    Private function to run an execution module function on the minions.
+    LocalClient is not thread-safe, so every call creates its own client.
+    """
+    client = salt.client.LocalClient(__opts__['conf_file'])
+    return client.cmd(tgt, fun, arg=list(arg), tgt_type=tgt_type, timeout=timeout)
+
+
+def _kwargs(**kwargs):
+    """
+    Private function to pass keyword arguments in the "arg" list of LocalClient.cmd
+    """
+    kwargs['__kwarg__'] = True
+    return [kwargs]
+
+
+def _expected_minions(tgt, tgt_type='glob'):
+    """
+    Private function to get the minions matching the target, also the ones
+    which do not answer
+    """
+    res = salt.utils.minions.CkMinions(__opts__).check_minions(tgt, tgt_type)
+    # a dictionary since 2018.3, a list before
+    return sorted(res['minions'] if isinstance(res, dict) else res)
+
+
+def _cmd_one(minion, fun, arg=(), timeout=None):
+    """
+    Private function to run an execution module function on one minion
+    """
+    return _cmd(minion, fun, arg, timeout=timeout).get(minion)
+
+
+# =========================================================
+#              F L E E T   U P G R A D E
+# =========================================================
+
+def _upgrade_one(minion, image_url, build_num, image_timeout, ready_timeout, ready_interval, ops_slot):
+    """
+    Private function to upgrade one MOD:
+      image_upgrade -> restart -> wait until mod.version returns the new build -> prewarm
+    The ops_slot semaphore is held only while the image is downloaded.
+    Output:
+      * result dictionary of the device
+    """
+    started = time.time()
+    res = {'minion': minion, 'url': image_url, 'out': False}
+
+    with ops_slot:
+        ret = _cmd_one(minion, 'mod.image_upgrade', [image_url, build_num, False, image_timeout],
+                       timeout=image_timeout + 60)
+    if not ret or not ret.get('out'):
+        res['message'] = 'image_upgrade failed: {0}'.format(ret)
+        res['seconds'] = round(time.time() - started, 1)
+        return res
+
+    ret = _cmd_one(minion, 'mod.restart', _kwargs(sleep_time=0), timeout=120)
+    if not ret or not ret.get('out'):
+        res['message'] = 'restart failed: {0}'.format(ret)
+        res['seconds'] = round(time.time() - started, 1)
+        return res
+
+    # readiness gate instead of the fixed sleep
+    deadline = time.time() + ready_timeout
+    while time.time() < deadline:
+        time.sleep(ready_interval)
+        try:
+            ret = _cmd_one(minion, 'mod.version', timeout=60)
+        except Exception as exception:
+            log.debug('{0}: mod.version failed: {1}'.format(minion, exception))
+            continue
+        if ret and ret.get('out') and str(ret.get('message')) == str(build_num):
+            # open the sessions for the next jobs while the device is idle
+            # (the proxy skips it when its jobs run in the forked processes)
+            try:
+                _cmd_one(minion, 'mod.prewarm', timeout=60)
+            except Exception as exception:
+                log.debug('{0}: mod.prewarm failed: {1}'.format(minion, exception))
+            res['out'] = True
+            res['message'] = 'upgraded to build {0}'.format(build_num)
+            res['seconds'] = round(time.time() - started, 1)
+            return res
+
+    res['message'] = 'build {0} is not running after {1}s: {2}'.format(build_num, ready_timeout, ret)
+    res['seconds'] = round(time.time() - started, 1)
+    return res
+
+
+def upgrade(tgt, build_num, tgt_type='glob', image_url=None, debug=False,
+            max_parallel=5, wave_size=None, bandwidth_mbps=None, image_mbps=100,
+            image_timeout=300, ready_timeout=600, ready_interval=15, max_failure_rate=0.2):
+    """
+    Upgrade many MOD devices in waves
+
+    Parameters
+    ----------
+    tgt, tgt_type    : Target of the MOD proxy-minions
+    build_num        : The build number to upgrade to
+    image_url        : The image URL (default: http://<pod:ops:mgmt:ip>/mod/mod-[debug-]<build_num>.img)
+    debug            : Upgrade to the debug build (default: False)
+    max_parallel     : Max number of devices upgraded at the same time (default: 5)
+    wave_size        : Number of devices in a wave (default: max_parallel)
+    bandwidth_mbps   : Download budget of one ops node, Mbit/s (default: None - no limit)
+    image_mbps       : Expected download rate of one device, Mbit/s (default: 100)
+                       An ops node serves at most bandwidth_mbps / image_mbps devices at once
+    image_timeout    : Seconds to wait for the image download (default: 300)
+    ready_timeout    : Seconds to wait for the new build after the restart (default: 600)
+    ready_interval   : Seconds between the readiness checks (default: 15)
+    max_failure_rate : Stop after the wave if the rate of failed devices is greater (default: 0.2)
+
+    Returns
+    -------
+    {'upgraded': [...], 'failed': [...], 'skipped': [...], 'not_started': [...], 'halted': ...}
+    The devices which do not answer mod.version or have no ops node IP
+    (without image_url) are reported as failed and are not upgraded.
+
+    Usage
+    -----
+
+    .. code-block:: bash
+
+        sudo salt-run mod.upgrade 'mod*' 1234567 max_parallel=10 bandwidth_mbps=1000
+
+    """
+    wave_size = int(wave_size or max_parallel)
+    res = {'upgraded': [], 'failed': [], 'skipped': [], 'not_started': [], 'halted': False}
+    started = time.time()
+
+    # current builds: skip the devices which are already upgraded,
+    # the devices which do not answer are reported as failed
+    versions = _cmd(tgt, 'mod.version', tgt_type=tgt_type, timeout=60)
+    targets = []
+    for minion in sorted(set(versions) | set(_expected_minions(tgt, tgt_type))):
+        ver = versions.get(minion)
+        if ver is None:
+            res['failed'].append({'minion': minion, 'out': False, 'message': 'no answer to mod.version, not upgraded'})
+        elif isinstance(ver, dict) and ver.get('out') and str(ver.get('message')) == str(build_num):
+            res['skipped'].append(minion)
+        else:
+            targets.append(minion)
+
+    # image URL of every device and the download budget of every ops node
+    ops_ips = {}
+    if targets and not image_url:
+        ops_ips = _cmd(targets, 'pillar.get', ['pod:ops:mgmt:ip'], tgt_type='list', timeout=60)
+        for minion in list(targets):
+            if not ops_ips.get(minion):
+                res['failed'].append({'minion': minion, 'out': False,
+                                      'message': 'pillar pod:ops:mgmt:ip is not set, pass image_url'})
+                targets.remove(minion)
+    _progress('{0} device(s) to upgrade to build {1}, {2} already upgraded, {3} failed'.format(
+        len(targets), build_num, len(res['skipped']), len(res['failed'])))
+    if not targets:
+        return res
+    prechecked = len(res['failed'])
+
+    build_name = 'debug-{0}'.format(build_num) if debug else str(build_num)
+    urls = dict((minion, image_url or 'http://{0}/mod/mod-{1}.img'.format(ops_ips[minion], build_name))
+                for minion in targets)
+
+    per_ops = max_parallel
+    if bandwidth_mbps:
+        per_ops = max(1, min(max_parallel, int(float(bandwidth_mbps) // float(image_mbps))))
+    ops_slots = dict((ops_ip, threading.BoundedSemaphore(per_ops)) for ops_ip in set(ops_ips.get(m) for m in targets))
+    slots = threading.BoundedSemaphore(int(max_parallel))
+    lock = threading.Lock()
+
+    def worker(minion):
+        ops_slot = ops_slots[ops_ips.get(minion)]
+        with slots:
+            try:
+                dev_res = _upgrade_one(minion, urls[minion], build_num, int(image_timeout),
+                                       int(ready_timeout), int(ready_interval), ops_slot)
+            except Exception as exception:
+                dev_res = {'minion': minion, 'out': False, 'message': str(exception)}
+        with lock:
+            res['upgraded' if dev_res['out'] else 'failed'].append(dev_res)
+        _progress('{0}: {1}'.format(minion, dev_res['message']))
+
+    for wave_start in range(0, len(targets), wave_size):
+        wave = targets[wave_start:wave_start + wave_size]
+        _progress('wave {0}: {1}'.format(wave_start // wave_size + 1, ', '.join(wave)))
+        threads = [threading.Thread(target=worker, args=(minion,)) for minion in wave]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # the failure rate of the upgrades, not of the pre-checks
+        done = len(res['upgraded']) + len(res['failed']) - prechecked
+        failure_rate = float(len(res['failed']) - prechecked) / done
+        if failure_rate > float(max_failure_rate):
+            res['halted'] = True
+            res['not_started'] = targets[wave_start + wave_size:]
+            _progress('failure rate {0:.0%} is greater than {1:.0%}, halting the rollout'.format(failure_rate, float(max_failure_rate)))
+            break
+
+    res['seconds'] = round(time.time() - started, 1)
+    return res
+
+
+# =========================================================
+#            F L E E T   L I C E N S E   R E P O R T
+# =========================================================
+
+# Columns of the license report
+REPORT_FIELDS = ['device', 'vendor', 'valid', 'days_remaining', 'expires', 'expired', 'bucket', 'latency']
+
+
+def license_report(tgt='*', tgt_type='glob', workers=10, thresholds=None, max_age=0,
+                   fmt='json', out=None, timeout=60):
+    """
+    Collect the license tables (mod.license_table) of all the MOD devices
+    in parallel and write a single report sorted by days remaining
+
+    Parameters
+    ----------
+    tgt, tgt_type : Target of the MOD proxy-minions (default: '*')
+    workers       : Number of devices queried at the same time (default: 10)
+    thresholds    : Expiry threshold buckets, days (default: [7, 30, 90])
+    max_age       : Seconds. Let the devices reuse the licensing information
+                    collected less than max_age seconds ago (default: 0)
+    fmt           : Report format: json or csv (default: json)
+    out           : Report file (default: <cachedir>/mod/license_report.<fmt>)
+    timeout       : Seconds to wait for a device (default: 60)
+
+    Returns
+    -------
+        {'report': <file>, 'devices': N, 'rows': N, 'failed': {device: error},
+         'expiring': {<threshold>: <number of licenses expiring within the threshold>}}
+
+    Every row of the report has the device, its license record and the
+    device collection latency in seconds.
+
+    Usage
+    -----
+
+    .. code-block:: bash
+
+        sudo salt-run mod.license_report
+        sudo salt-run mod.license_report 'mod*' workers=20 fmt=csv out=/tmp/licenses.csv
+
+    """
+    thresholds = thresholds or [7, 30, 90]
+    if fmt not in ('json', 'csv'):
+        return {'message': 'Unsupported report format: {0}'.format(fmt), 'out': False}
+    if out is None:
+        out = os.path.join(__opts__['cachedir'], 'mod', 'license_report.{0}'.format(fmt))
+
+    minions = sorted(_cmd(tgt, 'test.ping', tgt_type=tgt_type, timeout=timeout))
+    _progress('collecting license tables from {0} device(s) with {1} worker(s)'.format(len(minions), workers))
+
+    rows = []
+    failed = {}
+    lock = threading.Lock()
+    pending = queue.Queue()
+    for minion in minions:
+        pending.put(minion)
+
+    def worker():
+        while True:
+            try:
+                minion = pending.get_nowait()
+            except queue.Empty:
+                return
+            started = time.time()
+            try:
+                ret = _cmd_one(minion, 'mod.license_table', _kwargs(thresholds=thresholds, max_age=max_age),
+                               timeout=timeout)
+            except Exception as exception:
+                ret = {'out': False, 'message': str(exception)}
+            latency = round(time.time() - started, 3)
+            with lock:
+                if not isinstance(ret, dict) or not ret.get('out'):
+                    failed[minion] = ret.get('message') if isinstance(ret, dict) else ret
+                    continue
+                for record in ret['message']:
+                    row = dict(record)
+                    row['device'] = minion
+                    row['latency'] = latency
+                    rows.append(row)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(int(workers), len(minions))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    rows.sort(key=lambda row: (row['days_remaining'] is not None, row['days_remaining'], row['device']))
+
+    dirname = os.path.dirname(out)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    with open(out, 'w') as report_file:
+        if fmt == 'json':
+            json.dump(rows, report_file, indent=2, sort_keys=True)
+        else:
+            writer = csv.DictWriter(report_file, fieldnames=REPORT_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            for row in rows:
+                writer.writerow(row)
+
+    expiring = dict((threshold, sum(1 for row in rows if row['within'].get(str(threshold))))
+                    for threshold in thresholds)
+    _progress('license report written to {0}'.format(out))
+    return {'report': out,
+            'devices': len(minions),
+            'rows': len(rows),
+            'failed': failed,
+            'expiring': expiring}
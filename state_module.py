@@ -14,20 +14,78 @@ Script: //_states/mod.py
 """
 from __future__ import absolute_import
 import logging
-import time
+
+# relative include of _utils directory- to find mod_utils
+import sys
+import os
+sys.path.append(os.path.dirname(__file__))
+import mod_utils
 
 log = logging.getLogger()
 
 
+# =====================================
+# Optional profiling of the state functions
+#
+def _profiled(state, func, *args):
+    """
+    Private function to run the state function as a span of the trace,
+    with the profiling if it is enabled in the component pillar
+    (see mod_utils.profile_config); the profile files are reported in the comment
+    """
+    profile = None
+    config = mod_utils.profile_config(__pillar__)
+    if config.get('enabled', False):
+        profile = mod_utils.start_profile('mod.{0}'.format(state), mod_utils.profile_dir(__opts__, __pillar__),
+                                          cprofile=config.get('cprofile', True))
+
+    try:
+        with mod_utils.span('state', 'mod.{0}'.format(state), name=args[0]):
+            ret = func(*args)
+    finally:
+        if profile is not None:
+            res = mod_utils.stop_profile(profile)
+    if profile is not None and isinstance(ret, dict):
+        ret['comment'] = ret.get('comment', '') + " Profile: {0}, trace: {1}".format(res['profile'] or res['timeline'], res['otlp'])
+    return ret
+
+
+# =====================================
+# Dry-run plan of the commands from JSON file
+#
+def _plan(ret, name, action):
+    """
+    Private function to fill the comment and the changes of the test=True
+    result with the commands which would be sent to the device (see mod.plan)
+    """
+    res = __salt__['mod.plan'](name)
+    if res['out'] is not True:
+        ret['comment'] = "{0} from {1} file. Plan failed: {2}".format(action, name, res['message'])
+        return ret
+
+    plan = res['message']
+    ret['changes'] = {'plan': plan['commands']}
+    ret['comment'] = "{0} from {1} file: {2} command(s) in {3} context(s), " \
+                     "{4} session(s), estimated {5}s; {6} command(s) already applied, " \
+                     "{7} command(s) not compared".format(
+                         action, name, sum(len(cmds) for cmds in plan['commands'].values()),
+                         plan['mode_switches'], plan['sessions'], plan['estimated_seconds'],
+                         len(plan['unchanged']), len(plan['uncompared']))
+    return ret
+
+
 # =========================================================
 # Verify, load licenses, and verify again
 #
-def licenses_loaded(name,host='127.0.0.1',usr='super',passwd='12345'):
+def licenses_loaded(name,host='127.0.0.1',usr='super',passwd='12345',max_age=0):
     """
     Enforce that the MOD licenses will be loaded
 
     name
       The JSON file with MOD commands
+    max_age
+      Seconds. Do not check the device if the licenses were found
+      loaded less than max_age seconds ago (default: 0 - always check)
 
     Example:
 
@@ -36,11 +94,23 @@ def licenses_loaded(name,host='127.0.0.1',usr='super',passwd='12345'):
        load-licenses:
          mod.licenses_loaded:
            - name: /path/to/json/file with "load-licenses" command
+           - max_age: 3600
 
     .. note::
        Example of JSON file:
        * /tmp/mod/mod-dpdev_load-licenses.json
 
+    .. note::
+       The status of the licenses is saved as the "license_status" fact
+       of the device, see mod.facts
+
+    """
+    return _profiled('licenses_loaded', _licenses_loaded, name, host, usr, passwd, max_age)
+
+
+def _licenses_loaded(name, host='127.0.0.1', usr='super', passwd='12345', max_age=0):
+    """
+    Private function to enforce the state, see licenses_loaded()
     """
     log.debug('licenses_loaded called name: {}'.format(name))
 
@@ -50,78 +120,98 @@ def licenses_loaded(name,host='127.0.0.1',usr='super',passwd='12345'):
            'changes': {},
            'comment': ''}
 
-    # -------------------------
-    # Verifying if Licenses have been already loaded
-    res = __salt__['mod.check_licenses'](host, usr, passwd)
-    log.debug('result of _state.mod.{} is: "{}:'.format(name,res))
-
     # Check if we're running in test=True mode
     if __opts__['test']:
         log.debug('running in test mode')
+        # -------------------------
+        # Verifying if Licenses have been already loaded
+        res = __salt__['mod.check_licenses'](host, usr, passwd, max_age=max_age)
         # return the result
         ret['result'] = None
-        if 'True' in res:
-        #if 'already loaded' in res['message']:
+        if 'already loaded' in res['message']:
             ret['comment'] = res['message']
         else:
-            ret['comment'] = "Licenses will be loaded from {0} file".format(name)
+            _plan(ret, name, "Licenses will be loaded")
         return ret
 
-    # Generating the name of the status file. Ex.: /tmp/mod1-dp2-dev4-lic-status
-    comp_name = __pillar__['node']['component']
-    pod_name  = __pillar__['node']['pod']
-    tmp_lic_status_fname = "/tmp/{}-{}-lic-status".format(comp_name, pod_name)
+    store = mod_utils.state_store(__opts__, __pillar__)
 
-    with open(tmp_lic_status_fname, "w") as lic_status_file:
-        if 'already loaded' in res['message']:
-            log.debug('already loaded')
-            # we will check the status file during the running the highstate next time
-            lic_status_file.write("True")
-            ret['result'] = True
-            ret['comment'] = res['message']
-        else:
-            log.debug('not loaded, starting load...')
-            # it's important to save False here, before the following attempts to load licenses;
-            # it looks like we save "at that time the license was not loaded" status
-            lic_status_file.write("False")
+    # -------------------------
+    # Verifying if Licenses have been already loaded (REST)
+    dates = None
+    if store.get('license_status') is False:
+        # not loaded at the last check: the current license dates (CLI) will be
+        # needed too, read them while the REST check runs
+        res, dates = mod_utils.run_parallel(
+            (__salt__['mod.check_licenses'], (host, usr, passwd), {'max_age': max_age}),
+            (__salt__['mod.get_license_dates'], (), {}))
+    else:
+        res = __salt__['mod.check_licenses'](host, usr, passwd, max_age=max_age)
+    log.debug('result of _state.mod.{} is: "{}:'.format(name,res))
+
+    if 'already loaded' in res['message']:
+        log.debug('already loaded')
+        # we will check the status during the running the highstate next time
+        store.set('license_status', True)
+        ret['result'] = True
+        ret['comment'] = res['message']
+    else:
+        log.debug('not loaded, starting load...')
+        # it's important to save False here, before the following attempts to load licenses;
+        # it looks like we save "at that time the license was not loaded" status
+        store.set('license_status', False)
+        # -------------------------
+        # prepare output as a result of the first verification:
+        # current license dates (CLI "show licenses"), only when they have to be loaded
+        if dates is None:
+            dates = __salt__['mod.get_license_dates']()
+        ret['changes'].setdefault('old', None)
+        ret['changes'].setdefault('new', dates['message'])
+
+        # Loop - trying to load the licenses
+        # Rapid succession of downloading license may cause instability,
+        # so the delays between the attempts are longer than the default ones
+        policy = mod_utils.retry_policy(__pillar__, 'licenses', attempts=3, base_delay=10, max_delay=60, deadline=600)
+        failed = None
+        for iter in policy:
+            if iter > 0:
+                # the previous load may have just been slow - do not download the license again
+                res = __salt__['mod.check_licenses'](host, usr, passwd)
+                if 'already loaded' in res['message']:
+                    log.debug('now loaded')
+                    ret['result'] = True
+                    ret['changes']['new'] = "Success"
+                    ret['comment'] = "Licenses loaded successfully"
+                    store.set('license_status', True)
+                    break
             # -------------------------
-            # prepare output as a result of the first verification
-            res = __salt__['mod.get_license_dates']()
-            ret['changes'].setdefault('old', None)
-            ret['changes'].setdefault('new', res['message'])
+            # load licenses
+            log.debug('attempt: ' + str(iter) + '; name: ' + str(name))
+            res = policy.call(__salt__['mod.exec_commands_from_file'], name, config=failed)
 
-            # Loop - trying to load the licenses
-            for iter in range(3):
-                # -------------------------
-                # load licenses
-                log.debug('attempt: ' + str(iter) + '; name: ' + str(name))
-                res = __salt__['mod.exec_commands_from_file'](name)
-                
-                #Sleep 60 seconds before checking again, and attempting re-load.
-                #Rapid succession of downloading license may cause instability
-                time.sleep(60)
-                
-                if res['out'] is True:
-                    # check if licenses just loaded
-                    res = __salt__['mod.check_licenses'](host, usr, passwd)
-                    if 'already loaded' in res['message']:
-                        log.debug('now loaded')
-                        ret['result'] = True
-                        ret['changes']['new'] = "Success"
-                        ret['comment'] = "Licenses loaded successfully"
-                        #write true..but already opened file needs to be truncated so you don't end up with "FalseTrue"
-                        lic_status_file.truncate()
-                        lic_status_file.write("True")
-                        break
-                else:
-                    log.info("licenses_loaded error: " + str(res))
-                    ret['result'] = False
-                    ret['comment'] += "Failed attempt: {}, Result: {}. ".format(iter, str(res))
-
-                # end if-else
-            # end for
-        # end if-else
-    # end with
+            if res['out'] is True:
+                failed = None
+                # wait until the licenses just loaded are valid
+                res = __salt__['mod.wait_licenses_loaded'](host, usr, passwd)
+                if 'already loaded' in res['message']:
+                    log.debug('now loaded')
+                    ret['result'] = True
+                    ret['changes']['new'] = "Success"
+                    ret['comment'] = "Licenses loaded successfully"
+                    store.set('license_status', True)
+                    break
+            else:
+                log.info("licenses_loaded error: " + str(res))
+                # retry only the failed commands
+                failed = res.get('failed') or None
+                ret['result'] = False
+                ret['comment'] += "Failed attempt: {}, Result: {}. ".format(iter, str(res))
+                if not policy.should_retry(res):
+                    break
+
+            # end if-else
+        # end for
+    # end if-else
     return ret
 
 # =========================================================
@@ -150,6 +240,13 @@ def system_db_downloaded(name, targeted_av_vendor='company'):
              targeted_av_vendor: 'company'
 
 
+    """
+    return _profiled('system_db_downloaded', _system_db_downloaded, name, targeted_av_vendor)
+
+
+def _system_db_downloaded(name, targeted_av_vendor='company'):
+    """
+    Private function to enforce the state, see system_db_downloaded()
     """
     log.debug('system_db_downloaded called name: {}; targeted_av_vendor: {}'.format(name, targeted_av_vendor))
 
@@ -215,6 +312,13 @@ def system_db_expiry(name, targeted_av_vendor_list=None, days_from_now=0):
              targeted_av_vendor_list: ['Vendor']
              days_from_now: 90
 
+    """
+    return _profiled('system_db_expiry', _system_db_expiry, name, targeted_av_vendor_list, days_from_now)
+
+
+def _system_db_expiry(name, targeted_av_vendor_list=None, days_from_now=0):
+    """
+    Private function to enforce the state, see system_db_expiry()
     """
     if targeted_av_vendor_list is None:
         targeted_av_vendor_list = ['BASE']
@@ -248,7 +352,7 @@ def system_db_expiry(name, targeted_av_vendor_list=None, days_from_now=0):
 # =========================================================
 # Image_upgrade
 #
-def image_upgrade(name, imageUrl = None, buildNum = 0, forceImage = False):
+def image_upgrade(name, imageUrl = None, buildNum = 0, forceImage = False, timeout = 90):
     """
         Retrieve a MOD image (.img) and load it, with optional reboot
 
@@ -256,6 +360,7 @@ def image_upgrade(name, imageUrl = None, buildNum = 0, forceImage = False):
     ----------
     imageUrl :  The full URL to the .img image. (default: None)
     buildNum :  The build number to boot to (default: 0)
+    timeout  :  Seconds to wait for the image download (default: 90)
     
     Returns
     -------
@@ -273,6 +378,13 @@ def image_upgrade(name, imageUrl = None, buildNum = 0, forceImage = False):
       - if un-successful, 'out' is False
 
     """
+    return _profiled('image_upgrade', _image_upgrade, name, imageUrl, buildNum, forceImage, timeout)
+
+
+def _image_upgrade(name, imageUrl=None, buildNum=0, forceImage=False, timeout=90):
+    """
+    Private function to enforce the state, see image_upgrade()
+    """
 
     log.debug('mod image_upgrade called imageUrl: {}; buildNum: {}, forceImage: {}'.format(imageUrl, buildNum, forceImage))
 
@@ -282,7 +394,7 @@ def image_upgrade(name, imageUrl = None, buildNum = 0, forceImage = False):
            'changes': {},
            'comment': ''}
 
-    res = __salt__['mod.image_upgrade'](imageUrl, buildNum, forceImage)
+    res = __salt__['mod.image_upgrade'](imageUrl, buildNum, forceImage, timeout)
 
     # Check if we're running in test=True mode
     if __opts__['test']:
@@ -320,6 +432,13 @@ def mod_added(name):
         Example of JSON file:
         * /tmp/mod/mod-dpdev4_add-mod-appliances.json
     """
+    return _profiled('mod_added', _mod_added, name)
+
+
+def _mod_added(name):
+    """
+    Private function to enforce the state, see mod_added()
+    """
     log.debug('mod_added called name: {}'.format(name))
 
     # Prepare
@@ -343,7 +462,7 @@ def mod_added(name):
         if 'already added' in res['message']:
             ret['comment'] = res['message']
         else:
-            ret['comment'] = "MA info will be added from {0} file".format(name)
+            _plan(ret, name, "MA info will be added")
         return ret
 
     if 'already added' in res['message']:
@@ -354,17 +473,20 @@ def mod_added(name):
         # -------------------------
         # prepare the output as a result of the first verification
         #
-        res = __salt__['mod.get'](ma_command)
+        res = __salt__['mod.get'](mod_command)
         ret['changes'].setdefault('old', None)
         ret['changes'].setdefault('new', res['message'])
 
         # Loop - trying to load the licenses
-        for iter in range(3):
+        policy = mod_utils.retry_policy(__pillar__, 'add_mod', attempts=3, base_delay=2, deadline=300)
+        failed = None
+        for iter in policy:
             # -------------------------
             # add MA appliances
             log.debug('attempt: ' + str(iter) + '; name: ' + str(name))
-            res = __salt__['mod.exec_commands_from_file'](name)
+            res = policy.call(__salt__['mod.exec_commands_from_file'], name, config=failed)
             if res['out'] is True:
+                failed = None
                 # -------------------------
                 # check if MA appliances just loaded
                 res = __salt__['mod.check_mod']()
@@ -376,8 +498,12 @@ def mod_added(name):
                     break
             else:
                 log.info("ma_added error: " + str(res))
+                # retry only the failed commands
+                failed = res.get('failed') or None
                 ret['result'] = False
                 ret['comment'] += "Failed attempt: {}, Result: {}. ".format(iter, str(res))
+                if not policy.should_retry(res):
+                    break
 
         # end for
     return ret
@@ -386,12 +512,15 @@ def mod_added(name):
 # =====================================
 # Configure MOD by using commands from JSON file
 #
-def configured(name):
+def configured(name, force=False):
     """
     Enforce that the MOD node will be configured
 
     name
         The JSON file with MOD configuration commands
+    force
+        Verify the configuration on the device even if the same
+        commands have been already applied and verified (default: False)
 
     Example:
 
@@ -405,7 +534,14 @@ def configured(name):
        Example of JSON file:
        * '/tmp/mod/mv1-dp1-mod2_config.json'
     """
-    log.debug('configured called name: {}; '.format(name))
+    return _profiled('configured', _configured, name, force)
+
+
+def _configured(name, force=False):
+    """
+    Private function to enforce the state, see configured()
+    """
+    log.debug('configured called name: {}; force: {}'.format(name, force))
 
     # Prepare
     ret = {'name': name,
@@ -414,6 +550,18 @@ def configured(name):
            'comment': ''
            }
 
+    # -------------------------
+    # Check if the same commands have been already applied and verified
+    # and the device has not been restarted or upgraded since then
+    #
+    if not force:
+        res = __salt__['mod.config_applied'](name)
+        log.debug('config_applied: ' + str(res))
+        if res['out'] is True:
+            ret['result'] = None if __opts__['test'] else True
+            ret['comment'] = "MOD already configured. {}".format(res['message'])
+            return ret
+
     # -------------------------
     # Verifying MOD configuration
     #
@@ -427,7 +575,7 @@ def configured(name):
         if 'Success' in res['message']:
             ret['comment'] = "MOD already configured"
         else:
-            ret['comment'] = "MOD will be configured from {0} file".format(name)
+            _plan(ret, name, "MOD will be configured")
         return ret
 
     if 'Success' in res['message']:
@@ -445,12 +593,15 @@ def configured(name):
             ret['changes'].setdefault('new', res['new'])
 
         # Loop - trying to configure MOD
-        for iter in range(3):
+        policy = mod_utils.retry_policy(__pillar__, 'config', attempts=3, base_delay=2, deadline=600)
+        failed = None
+        for iter in policy:
             # -------------------------
             # configure MOD from json file
             log.debug('attempt: ' + str(iter) + '; name: ' + str(name))
-            res = __salt__['mod.exec_commands_from_file'](name)
+            res = policy.call(__salt__['mod.exec_commands_from_file'], name, config=failed)
             if res['out'] is True:
+                failed = None
                 # -------------------------
                 # verifying MOD again
                 res = __salt__['mod.verify'](name)
@@ -463,8 +614,12 @@ def configured(name):
                     break
             else:
                 log.info("configured error: " + str(res))
+                # retry only the failed commands
+                failed = res.get('failed') or None
                 ret['result'] = False
                 ret['comment'] += "Failed attempt: {}, Result: {}. ".format(iter, str(res))
+                if not policy.should_retry(res):
+                    break
 
         # end for
     return ret
@@ -0,0 +1,1918 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the MOD proxy, execution and state modules.
+
+Script: //_utils/mod_utils.py
+
+:maturity:      new
+:depends:       -
+:platform:      all
+
+.. note::
+   The modules load this file with the same relative include as rest_helper:
+     sys.path.append(os.path.dirname(__file__))
+     import mod_utils
+   Keep it compatible with the Python version used on the Node.
+
+"""
+
+# Import Python libs
+from __future__ import absolute_import
+import bisect
+import cProfile
+import datetime
+import errno
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import socket
+import sqlite3
+import threading
+import time
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+# Logging
+log = logging.getLogger(__name__)
+
+
+# =========================================================
+#                  R E T R Y   P O L I C Y
+# =========================================================
+
+# Exceptions which are worth another attempt: the device is rebooting,
+# the SSH/REST login timed out, the connection was closed, etc.
+TRANSIENT_EXCEPTIONS = (socket.timeout, EOFError)
+
+# Errors of the socket calls (socket.error, OSError with errno) which are
+# worth another attempt; other OS errors (no such file, permission denied)
+# are local problems and are not retried
+TRANSIENT_ERRNOS = frozenset(getattr(errno, name) for name in
+                             ('ECONNRESET', 'ECONNREFUSED', 'ECONNABORTED', 'ETIMEDOUT', 'EHOSTUNREACH',
+                              'ENETUNREACH', 'ENETDOWN', 'EHOSTDOWN', 'EPIPE', 'EAGAIN')
+                             if hasattr(errno, name))
+
+# Text of the results (or exceptions) which are worth another attempt
+TRANSIENT_MARKERS = ['timeout', 'timed out', 'connection refused', 'connection reset',
+                     'not responding', 'temporarily unavailable', 'try again']
+
+# Text of the exception raised when the circuit breaker rejects a call
+CIRCUIT_OPEN_MARKER = 'circuit open'
+
+
+def is_transient(result):
+    """
+    Default retry-on classification
+
+    Input:
+      * result - the result dictionary of an execution module function
+                 ({'out': ..., 'message': ...}, optionally 'transient' - the
+                 classification of the exception which failed it) or an exception
+    Output:
+      * True if another attempt may succeed
+    """
+    if isinstance(result, Exception):
+        if CIRCUIT_OPEN_MARKER in str(result):
+            # the device is known to be down - fail fast
+            return False
+        if isinstance(result, TRANSIENT_EXCEPTIONS):
+            return True
+        if isinstance(result, (socket.error, EnvironmentError)) and getattr(result, 'errno', None) is not None:
+            return result.errno in TRANSIENT_ERRNOS
+        text = str(result).lower()
+        return any(marker in text for marker in TRANSIENT_MARKERS)
+
+    if isinstance(result, dict):
+        # a failed check of the command's output is worth another attempt,
+        # a missing/broken JSON file is not
+        message = str(result.get('message', '')).lower()
+        if CIRCUIT_OPEN_MARKER in message:
+            return False
+        if result.get('transient') is not None:
+            return bool(result['transient'])
+        if 'no such file' in message or 'no json object' in message:
+            return False
+        return result.get('out') is not True
+
+    return not result
+
+
+class RetryPolicy(object):
+    """
+    Retry policy with exponential backoff, jitter and an overall deadline.
+
+    The policy is iterable, so it replaces the "for iter in range(3)" loops:
+
+    .. code-block:: python
+
+        policy = mod_utils.RetryPolicy(attempts=3, base_delay=2, deadline=300)
+        for iter in policy:
+            res = policy.call(__salt__['mod.exec_commands_from_file'], name)
+            if res['out'] is True or not policy.should_retry(res):
+                break
+
+    The iterator sleeps before every attempt except the first one:
+      delay = min(max_delay, base_delay * multiplier ** (attempt - 1)) +/- jitter
+    and stops when the attempts are exhausted or the next attempt
+    would start after the deadline.
+
+    Parameters:
+      * attempts   - max number of attempts (default: 3)
+      * base_delay - delay before the second attempt, seconds (default: 1)
+      * max_delay  - upper limit of a single delay, seconds (default: 30)
+      * multiplier - backoff multiplier (default: 2)
+      * jitter     - +/- fraction of the delay to randomize (default: 0.2)
+      * deadline   - overall time budget of all attempts, seconds (default: None - no limit)
+      * retry_on   - function(result_or_exception) -> bool (default: is_transient)
+    """
+
+    def __init__(self, attempts=3, base_delay=1.0, max_delay=30.0, multiplier=2.0,
+                 jitter=0.2, deadline=None, retry_on=None):
+        self.attempts = int(attempts)
+        self.base_delay = float(base_delay)
+        self.max_delay = float(max_delay)
+        self.multiplier = float(multiplier)
+        self.jitter = float(jitter)
+        self.deadline = deadline
+        self.retry_on = retry_on or is_transient
+        self.started = None
+        self.attempt = 0
+
+    @classmethod
+    def from_config(cls, config=None, **defaults):
+        """
+        Create a policy from a (pillar) dictionary, e.g.:
+          retry: {attempts: 5, base_delay: 2, deadline: 600}
+        The keys which are not in the dictionary are taken from defaults
+        """
+        kwargs = dict(defaults)
+        for key in ('attempts', 'base_delay', 'max_delay', 'multiplier', 'jitter', 'deadline'):
+            if config and key in config:
+                kwargs[key] = config[key]
+        return cls(**kwargs)
+
+    def delay(self, attempt):
+        """
+        Delay (seconds) before the given attempt (0-based)
+        """
+        if attempt <= 0:
+            return 0.0
+        delay = min(self.max_delay, self.base_delay * (self.multiplier ** (attempt - 1)))
+        if self.jitter:
+            delay += delay * self.jitter * random.uniform(-1, 1)
+        return max(0.0, delay)
+
+    def remaining(self):
+        """
+        Seconds left before the deadline (None if there is no deadline)
+        """
+        if self.deadline is None or self.started is None:
+            return None
+        return self.deadline - (time.time() - self.started)
+
+    def should_retry(self, result):
+        """
+        Check the result (or exception) of the last attempt
+        """
+        return bool(self.retry_on(result))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Run one attempt of func. The exception raised by func (e.g. the
+        connection reset while opening the session) is classified by
+        retry_on and returned as the failed result of the attempt:
+          {'out': False, 'message': ..., 'failed': None, 'transient': True|False}
+        """
+        try:
+            return func(*args, **kwargs)
+        except Exception as exception:
+            log.debug('retry policy: attempt {} raised {}: {}'.format(self.attempt, type(exception).__name__, exception))
+            return {'out': False,
+                    'message': '{0}: {1}'.format(type(exception).__name__, exception),
+                    'failed': None,
+                    'transient': bool(self.retry_on(exception))}
+
+    def __iter__(self):
+        self.started = time.time()
+        for attempt in range(self.attempts):
+            delay = self.delay(attempt)
+            remaining = self.remaining()
+            if remaining is not None and remaining < delay:
+                log.debug('retry policy: deadline of {}s reached after {} attempt(s)'.format(self.deadline, attempt))
+                return
+            if delay:
+                log.debug('retry policy: sleeping {:.1f}s before attempt {}'.format(delay, attempt))
+                sleep(delay, 'retry')
+            self.attempt = attempt
+            yield attempt
+
+
+def retry_policy(pillar, name, **defaults):
+    """
+    Create the retry policy of the <name> operation.
+    The defaults can be overridden in the component pillar:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            retry:
+              deadline: 900          # common settings
+              licenses:              # settings of the "licenses" operation
+                base_delay: 10
+    """
+    try:
+        config = device_profile(pillar).config.get('retry') or {}
+    except (KeyError, TypeError, AttributeError):
+        config = {}
+
+    merged = dict((key, value) for key, value in config.items() if not isinstance(value, dict))
+    merged.update(config.get(name) or {})
+    return RetryPolicy.from_config(merged, **defaults)
+
+
+# =========================================================
+#                 S H A R E D   S T A T E
+# =========================================================
+
+class SharedState(object):
+    """
+    Small state (JSON dictionary) shared by the processes of the proxy,
+    e.g. the forked job processes under "multiprocessing: True".
+
+    update(func) holds the file lock <path>.lock while it reads the state,
+    changes it with func and writes it back, so the read-modify-write is
+    atomic for the threads and the processes. Without a path (or fcntl)
+    the state is kept in the memory of the process.
+    """
+
+    def __init__(self, path=None):
+        self.path = path if HAS_FCNTL else None
+        self._data = {}
+        self._lock = threading.Lock()
+        dirname = os.path.dirname(self.path) if self.path else None
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by a concurrent job
+                if not os.path.isdir(dirname):
+                    raise
+
+    def update(self, func):
+        """
+        Call func(state) to change the state (dictionary) in place,
+        return the result of func. The state is not saved if func raises.
+        """
+        with self._lock:
+            if self.path is None:
+                return func(self._data)
+            with open(self.path + '.lock', 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    data = self._read()
+                    result = func(data)
+                    self._write(data)
+                    return result
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        try:
+            with open(self.path) as in_file:
+                return json.load(in_file)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, data):
+        try:
+            with open(self.path + '.tmp', 'w') as out_file:
+                json.dump(data, out_file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError, TypeError, ValueError) as exception:
+            log.debug('shared state {} is not saved: {}'.format(self.path, exception))
+
+
+def shared_state_dir(opts, pillar):
+    """
+    Directory of the SharedState files of the device:
+      <cachedir>/mod/shared/<comp>-<pod>
+    """
+    return os.path.join(opts.get('cachedir', '/var/cache/salt/proxy'), 'mod', 'shared', device_name(pillar))
+
+
+def shared_state_path(opts, pillar, name):
+    """
+    File of the SharedState <name> of the device:
+      <cachedir>/mod/shared/<comp>-<pod>/<name>.json
+    """
+    return os.path.join(shared_state_dir(opts, pillar), name + '.json')
+
+
+# =========================================================
+#               C I R C U I T   B R E A K E R
+# =========================================================
+
+class CircuitOpenError(Exception):
+    """
+    Raised when the circuit breaker rejects a call to the unreachable device
+    """
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Per-device circuit breaker.
+
+    * closed    - calls go to the device; after <threshold> consecutive
+                  connect failures the circuit opens
+    * open      - calls fail fast with CircuitOpenError for <cooldown> seconds
+    * half_open - after the cooldown one probe call goes to the device:
+                  success closes the circuit, failure opens it again;
+                  a probe without result for <cooldown> seconds (e.g. its
+                  job process died) is replaced by a new one
+
+    With a path the state is shared by the processes of the proxy
+    (see SharedState), so the job processes see the failures of each other.
+
+    Usage:
+
+    .. code-block:: python
+
+        breaker.before_call()          # raises CircuitOpenError
+        try:
+            conn = connect()
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    # the attributes kept in the shared state
+    FIELDS = ('state', 'failures', 'opened_at', 'probe_in_flight', 'probe_started',
+              'total_failures', 'total_rejected', 'last_error')
+
+    def __init__(self, name='mod', threshold=3, cooldown=60, path=None):
+        self.name = name
+        self.threshold = int(threshold)
+        self.cooldown = float(cooldown)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.probe_started = None
+        self.total_failures = 0
+        self.total_rejected = 0
+        self.last_error = None
+        self._shared = SharedState(path)
+
+    def _update(self, func):
+        """
+        Run func() on the attributes loaded from the shared state and save them
+        """
+        def apply(data):
+            for field in self.FIELDS:
+                if field in data:
+                    setattr(self, field, data[field])
+            result = func()
+            data.update((field, getattr(self, field)) for field in self.FIELDS)
+            return result
+        return self._shared.update(apply)
+
+    def before_call(self):
+        """
+        Check if the call is allowed, raise CircuitOpenError otherwise
+        """
+        retry_in = self._update(self._before_call)
+        if retry_in is not None:
+            raise CircuitOpenError('{} {}: device is unreachable, retry in {:.0f}s (last error: {})'.format(
+                CIRCUIT_OPEN_MARKER, self.name, retry_in, self.last_error))
+
+    def _before_call(self):
+        """
+        None if the call is allowed, the seconds to wait otherwise
+        """
+        now = time.time()
+        if self.state == self.OPEN and now - self.opened_at >= self.cooldown:
+            log.info('circuit breaker {}: cool-down is over, sending a probe'.format(self.name))
+            self.state = self.HALF_OPEN
+            self.probe_in_flight = False
+
+        if self.state == self.CLOSED:
+            return None
+        if self.state == self.HALF_OPEN and self.probe_in_flight and now - self.probe_started >= self.cooldown:
+            log.info('circuit breaker {}: no result of the probe for {:.0f}s, sending a new one'.format(
+                self.name, self.cooldown))
+            self.probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            self.probe_in_flight = True
+            self.probe_started = now
+            return None
+
+        self.total_rejected += 1
+        return self._retry_in()
+
+    def record_success(self):
+        self._update(self._record_success)
+
+    def _record_success(self):
+        if self.state != self.CLOSED:
+            log.info('circuit breaker {}: device is reachable again, closing the circuit'.format(self.name))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+
+    def record_failure(self, error=None):
+        self._update(lambda: self._record_failure(error))
+
+    def _record_failure(self, error):
+        self.failures += 1
+        self.total_failures += 1
+        self.last_error = str(error) if error is not None else None
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                log.warning('circuit breaker {}: {} consecutive failure(s), opening the circuit for {}s'.format(
+                    self.name, self.failures, self.cooldown))
+            self.state = self.OPEN
+            self.opened_at = time.time()
+            self.probe_in_flight = False
+
+    def _retry_in(self):
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.cooldown - (time.time() - self.opened_at))
+
+    def stats(self):
+        """
+        State of the circuit breaker as a dictionary
+        """
+        return self._update(lambda: {'state': self.state,
+                                     'consecutive_failures': self.failures,
+                                     'threshold': self.threshold,
+                                     'cooldown': self.cooldown,
+                                     'retry_in': round(self._retry_in(), 1),
+                                     'total_failures': self.total_failures,
+                                     'total_rejected': self.total_rejected,
+                                     'last_error': self.last_error})
+
+
+# =========================================================
+#                  R A T E   L I M I T E R
+# =========================================================
+
+class RateLimitError(Exception):
+    """
+    Raised when a call would wait for the rate limiter longer than allowed
+    """
+    pass
+
+
+class TokenBucket(object):
+    """
+    Token bucket: <burst> calls at once, then <rate> calls per second.
+    The callers reserve the tokens in the order of arrival and sleep until
+    their token is available, so they queue behind each other.
+    rate <= 0 disables the bucket.
+
+    With a path the bucket is shared by the processes of the proxy
+    (see SharedState), so the forked job processes queue behind each other.
+    """
+
+    def __init__(self, rate, burst=1, max_wait=None, path=None):
+        self.rate = float(rate)
+        self.burst = max(1.0, float(burst))
+        self.max_wait = float(max_wait) if max_wait else None
+        self._shared = SharedState(path)
+
+    def _state(self, data):
+        """
+        The shared state with the defaults of a new (full) bucket
+        """
+        for key, value in (('tokens', self.burst), ('updated', time.time()),
+                           ('calls', 0), ('waits', 0), ('waited', 0.0)):
+            data.setdefault(key, value)
+        return data
+
+    def reserve(self):
+        """
+        Take a token, return the seconds to wait for it
+        """
+        if self.rate <= 0:
+            return 0.0
+        return self._shared.update(self._reserve)
+
+    def _reserve(self, data):
+        state = self._state(data)
+        now = time.time()
+        state['tokens'] = min(self.burst, state['tokens'] + (now - state['updated']) * self.rate)
+        state['updated'] = now
+        wait = max(0.0, (1.0 - state['tokens']) / self.rate)
+        if self.max_wait is not None and wait > self.max_wait:
+            raise RateLimitError('rate limit: the call would wait {:.0f}s, max {:.0f}s'.format(wait, self.max_wait))
+        state['tokens'] -= 1.0
+        state['calls'] += 1
+        if wait:
+            state['waits'] += 1
+            state['waited'] += wait
+        return wait
+
+    def acquire(self):
+        """
+        Wait for a token, return the seconds waited
+        """
+        wait = self.reserve()
+        if wait:
+            sleep(wait, 'throttle')
+        return wait
+
+    def stats(self):
+        state = self._shared.update(self._state)
+        return {'rate': self.rate,
+                'burst': self.burst,
+                'calls': state['calls'],
+                'waits': state['waits'],
+                'waited': round(state['waited'], 1)}
+
+
+# Default budgets of the command classes: calls per second and burst.
+# The device is unstable with rapid "show licenses" and license downloads.
+RATE_LIMITS = {'show': {'rate': 5.0, 'burst': 10},
+               'config': {'rate': 5.0, 'burst': 20},
+               'license': {'rate': 0.1, 'burst': 2},
+               'restart': {'rate': 1.0 / 300, 'burst': 1}}
+
+
+def command_class(command, context=None):
+    """
+    Rate limiter class of the CLI command: show, config, license or restart.
+    None for the empty command (context switch, exit)
+    """
+    words = command.split()
+    if not words:
+        return None
+    if words[0] in ('restart', 'reboot', 'reload'):
+        return 'restart'
+    if any(word.startswith('licens') for word in words):
+        return 'license'
+    if context == 'CLI_CONFIG':
+        return 'config'
+    return 'show'
+
+
+class RateLimiter(object):
+    """
+    Per-device rate limiter with a TokenBucket per command class.
+    The budgets override RATE_LIMITS:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            rate_limits:
+              license:
+                rate: 0.05     # calls per second
+                burst: 1
+                max_wait: 600  # seconds, fail instead of waiting longer
+
+    With a directory the buckets are shared by the processes of the proxy:
+      <directory>/rate_limit_<class>.json
+    """
+
+    def __init__(self, budgets=None, directory=None):
+        merged = dict((name, dict(budget)) for name, budget in RATE_LIMITS.items())
+        for name, budget in (budgets or {}).items():
+            merged.setdefault(name, {}).update(budget or {})
+        self.buckets = dict((name, TokenBucket(budget.get('rate', 0), budget.get('burst', 1), budget.get('max_wait'),
+                                               path=os.path.join(directory, 'rate_limit_{0}.json'.format(name))
+                                               if directory else None))
+                            for name, budget in merged.items())
+
+    def acquire(self, cmd_class):
+        """
+        Wait for the budget of the command class, return the seconds waited
+        """
+        bucket = self.buckets.get(cmd_class)
+        if bucket is None:
+            return 0.0
+        wait = bucket.acquire()
+        if wait:
+            log.debug('rate limiter: waited {:.1f}s for a "{}" call'.format(wait, cmd_class))
+        return wait
+
+    def stats(self):
+        return dict((name, bucket.stats()) for name, bucket in self.buckets.items())
+
+
+# =========================================================
+#                D E V I C E   P R O F I L E
+# =========================================================
+
+class FrozenDict(dict):
+    """
+    Read-only dictionary of the device profile
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('the device profile is read-only')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+def freeze(value):
+    """
+    Read-only copy of the pillar data: dicts -> FrozenDict, lists -> tuples
+    """
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class DeviceProfile(object):
+    """
+    Resolved, immutable settings of the device, built from the "node" and
+    "pod:mod:<comp_name>" pillars. Use device_profile(pillar) to get it.
+    """
+    __slots__ = ('digest', 'name', 'comp_name', 'pod', 'mgmt_ip', 'username',
+                 'console_password', 'enable_password', 'node', 'config')
+
+    def __init__(self, node, config, digest):
+        values = {'digest': digest,
+                  'name': '{}-{}'.format(node['component'], node['pod']),
+                  'comp_name': node['component'],
+                  'pod': node['pod'],
+                  'mgmt_ip': config.get('mgmt', {}).get('ip'),
+                  'username': config.get('deploy', {}).get('userName'),
+                  'console_password': config.get('deploy', {}).get('consolePassword'),
+                  'enable_password': config.get('deploy', {}).get('enablePassword'),
+                  'node': freeze(node),
+                  'config': freeze(config)}
+        for key, value in values.items():
+            object.__setattr__(self, key, value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError('the device profile is read-only')
+
+    def __repr__(self):
+        return '<DeviceProfile {} {} {}>'.format(self.name, self.mgmt_ip, self.digest[:12])
+
+
+# The profiles by the device name, shared by all the modules of the process
+_profiles = {}
+_profiles_lock = threading.Lock()
+
+
+def device_profile(pillar):
+    """
+    DeviceProfile of the pillar. The profile is rebuilt only when the hash
+    of the "node" and "pod:mod:<comp_name>" pillars changes.
+    """
+    node = pillar['node']
+    config = pillar['pod']['mod'][node['component']]
+    digest = hashlib.sha1(json.dumps([node, config], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    key = (node['component'], node['pod'])
+    with _profiles_lock:
+        profile = _profiles.get(key)
+        if profile is None or profile.digest != digest:
+            profile = DeviceProfile(node, config, digest)
+            _profiles[key] = profile
+            log.debug('device profile built: {!r}'.format(profile))
+    return profile
+
+
+# =========================================================
+#                  S T A T E   S T O R E
+# =========================================================
+
+class StateStore(object):
+    """
+    Persistent store of the per-device facts (license status, DB expiry,
+    build, last verified config hash, ...).
+
+    Every fact is saved with a timestamp, so the callers can skip an
+    expensive device check if the stored fact is recent enough:
+
+    .. code-block:: python
+
+        store = mod_utils.state_store(__opts__, __pillar__)
+        if store.get('license_status', max_age=3600) is True:
+            ...
+
+    The facts are kept in a SQLite database, the writes are atomic and
+    safe for the concurrent jobs of the proxy-minion.
+    Values must be JSON serializable.
+    """
+
+    def __init__(self, path, device):
+        self.path = path
+        self.device = device
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # created by a concurrent job
+                if not os.path.isdir(dirname):
+                    raise
+        conn = self._connect()
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS facts ('
+                         'device TEXT NOT NULL, key TEXT NOT NULL, value TEXT, ts REAL NOT NULL, '
+                         'PRIMARY KEY (device, key))')
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def set(self, key, value, timestamp=None):
+        """
+        Save the fact
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('INSERT OR REPLACE INTO facts (device, key, value, ts) VALUES (?, ?, ?, ?)',
+                         (self.device, key, json.dumps(value), timestamp))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def record(self, key):
+        """
+        Get the fact with its timestamp: {'value': ..., 'timestamp': ..., 'age': ...}
+        or None if the fact is not stored
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute('SELECT value, ts FROM facts WHERE device = ? AND key = ?',
+                               (self.device, key)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        return {'value': json.loads(row[0]), 'timestamp': row[1], 'age': time.time() - row[1]}
+
+    def get(self, key, max_age=None, default=None):
+        """
+        Get the value of the fact, or default if the fact is not stored
+        or older than max_age seconds
+        """
+        rec = self.record(key)
+        if rec is None or (max_age is not None and rec['age'] > max_age):
+            return default
+        return rec['value']
+
+    def delete(self, key):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM facts WHERE device = ? AND key = ?', (self.device, key))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def all(self):
+        """
+        All the facts of the device: {key: record}
+        """
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT key, value, ts FROM facts WHERE device = ?', (self.device,)).fetchall()
+        finally:
+            conn.close()
+        now = time.time()
+        return dict((key, {'value': json.loads(value), 'timestamp': ts, 'age': now - ts})
+                    for key, value, ts in rows)
+
+
+def device_name(pillar):
+    """
+    Name of the device used as a key of the stored facts. Ex.: mod1-dp2-dev4
+    """
+    return device_profile(pillar).name
+
+
+def state_store(opts, pillar):
+    """
+    Create the StateStore of the device in the cache directory of the proxy-minion:
+      <cachedir>/mod/state.db
+    """
+    path = os.path.join(opts.get('cachedir', '/var/cache/salt/proxy'), 'mod', 'state.db')
+    return StateStore(path, device_name(pillar))
+
+
+# =========================================================
+#                   F A C T   C A C H E
+# =========================================================
+
+class FactCache(object):
+    """
+    In-memory cache of the device facts with timestamps, kept in the
+    proxy process and shared by the jobs running in it.
+    """
+
+    def __init__(self):
+        self._facts = {}
+        self._lock = threading.Lock()
+
+    def set(self, key, value, timestamp=None):
+        with self._lock:
+            self._facts[key] = (value, timestamp if timestamp is not None else time.time())
+
+    def record(self, key):
+        """
+        {'value': ..., 'timestamp': ..., 'age': ...} or None if the fact is not cached
+        """
+        with self._lock:
+            if key not in self._facts:
+                return None
+            value, timestamp = self._facts[key]
+        return {'value': value, 'timestamp': timestamp, 'age': time.time() - timestamp}
+
+    def get(self, key, max_age=None, default=None):
+        rec = self.record(key)
+        if rec is None or (max_age is not None and rec['age'] > max_age):
+            return default
+        return rec['value']
+
+    def delete(self, key):
+        with self._lock:
+            self._facts.pop(key, None)
+
+    def keys(self):
+        with self._lock:
+            return list(self._facts)
+
+
+# =========================================================
+#                  S E S S I O N   P O O L
+# =========================================================
+
+class PooledSession(object):
+    """
+    CLI session of the pool with the context (mode) it was left in
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.context = None
+        self.last_used = time.time()
+        self.reused = False
+        self.broken = False
+
+
+class SessionPool(object):
+    """
+    Pool of the idle CLI sessions of the device, kept in the proxy process.
+
+    acquire(context) prefers an idle session left in the same context, so
+    callers going back and forth between ENABLE and CLI_CONFIG get a
+    dedicated session per context instead of switching the mode.
+    Sessions idle longer than idle_ttl seconds are closed;
+    max_idle=0 disables the pool (every session is closed on release).
+    The pool is not shared between processes: a forked process must not use
+    the sessions of the parent (see pid).
+
+    Input:
+      * factory - function to open a new session
+      * closer  - function to close a session
+    """
+
+    def __init__(self, factory, closer, max_idle=2, idle_ttl=300):
+        self.factory = factory
+        self.closer = closer
+        self.max_idle = int(max_idle)
+        self.idle_ttl = float(idle_ttl)
+        # the sessions belong to the process which opened them
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.closed = 0
+        self.mode_switches = 0
+
+    def acquire(self, context=None):
+        """
+        Idle session (in the given context if possible) or a new one
+        """
+        with self._lock:
+            expired = self._expire()
+            entry = None
+            for candidate in reversed(self._idle):
+                if candidate.context == context:
+                    entry = candidate
+                    break
+            if entry is None and self._idle:
+                entry = self._idle[-1]
+            if entry is not None:
+                self._idle.remove(entry)
+                entry.reused = True
+                self.reused += 1
+        self._close(expired)
+        if entry is None:
+            entry = PooledSession(self.factory())
+            with self._lock:
+                self.created += 1
+        return entry
+
+    def release(self, entry):
+        """
+        Return the session to the pool, broken or extra sessions are closed
+        """
+        entry.last_used = time.time()
+        with self._lock:
+            keep = not entry.broken and len(self._idle) < self.max_idle
+            if keep:
+                self._idle.append(entry)
+        if not keep:
+            self._close([entry])
+
+    def warm(self, contexts, prime=None):
+        """
+        Open the idle sessions for the contexts which have none (up to max_idle)
+        Input:
+          * contexts - contexts of the sessions, e.g. ['ENABLE', 'CLI_CONFIG']
+          * prime    - function(session, context) to put a new session into the context
+        Output:
+          * number of the opened sessions
+        """
+        opened = 0
+        for context in contexts:
+            with self._lock:
+                if len(self._idle) >= self.max_idle or any(entry.context == context for entry in self._idle):
+                    continue
+            entry = PooledSession(self.factory())
+            with self._lock:
+                self.created += 1
+            try:
+                if prime is not None:
+                    prime(entry.session, context)
+                entry.context = context
+            except Exception:
+                entry.broken = True
+                raise
+            finally:
+                self.release(entry)
+            opened += 1
+        return opened
+
+    def clear(self):
+        """
+        Close all the idle sessions, e.g. after the device restart
+        """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        self._close(idle)
+
+    def switched(self):
+        with self._lock:
+            self.mode_switches += 1
+
+    def _expire(self):
+        now = time.time()
+        expired = [entry for entry in self._idle if now - entry.last_used > self.idle_ttl]
+        self._idle = [entry for entry in self._idle if entry not in expired]
+        return expired
+
+    def _close(self, entries):
+        for entry in entries:
+            try:
+                self.closer(entry.session)
+            except Exception as exception:
+                log.debug('closing pooled session failed: {}'.format(exception))
+            with self._lock:
+                self.closed += 1
+
+    def stats(self):
+        with self._lock:
+            return {'idle': len(self._idle),
+                    'idle_contexts': [entry.context for entry in self._idle],
+                    'max_idle': self.max_idle,
+                    'idle_ttl': self.idle_ttl,
+                    'created': self.created,
+                    'reused': self.reused,
+                    'closed': self.closed,
+                    'mode_switches': self.mode_switches}
+
+
+# =========================================================
+#                  C O N C U R R E N C Y
+# =========================================================
+
+def run_parallel(*calls):
+    """
+    Run the calls in parallel threads and wait for all of them
+
+    Input:
+      * calls - (function, args, kwargs) tuples
+    Output:
+      * list of the results in the order of the calls;
+        the first exception raised by a call is re-raised
+    """
+    results = [None] * len(calls)
+    errors = [None] * len(calls)
+
+    def runner(idx, func, args, kwargs):
+        try:
+            results[idx] = func(*args, **kwargs)
+        except Exception as exception:
+            errors[idx] = exception
+
+    threads = []
+    for idx, (func, args, kwargs) in enumerate(calls):
+        thread = threading.Thread(target=runner, args=(idx, func, args, kwargs))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error is not None:
+            raise error
+    return results
+
+
+def poll(func, until, timeout=60, interval=2, max_interval=10):
+    """
+    Call func() until until(result) is True or timeout seconds passed.
+    The interval between the calls grows 1.5 times up to max_interval.
+
+    Output:
+      * (True, result) if the condition is met, (False, last result) otherwise
+    """
+    deadline = time.time() + float(timeout)
+    result = None
+    while True:
+        result = func()
+        if until(result):
+            return True, result
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False, result
+        sleep(min(interval, remaining), 'poll')
+        interval = min(max_interval, interval * 1.5)
+
+
+class _Flight(object):
+    """
+    In-flight call of SingleFlight
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalescing of the concurrent identical calls: the first caller of a key
+    runs the function, the callers arriving while it is in flight wait and
+    get the same result (or exception).
+
+    The threads of the process are coalesced in memory. With a directory,
+    the processes (e.g. the job processes of the proxy) are coalesced too:
+    the leader holds a file lock of the key and saves the result (JSON) into
+    the directory, the callers of other processes wait for the lock and take
+    the result if the call finished after they arrived.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory if HAS_FCNTL else None
+        self.calls = 0
+        self.shared = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.shared += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._do_locked(key, func) if self.directory else func()
+        except Exception as exception:
+            flight.error = exception
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+    def _do_locked(self, key, func):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                pass
+        fname = os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        arrived = time.time()
+        with open(fname + '.lock', 'a') as lock_file:
+            # wait for the call in flight in another process
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(fname + '.json') as result_file:
+                        rec = json.load(result_file)
+                    if rec['finished'] >= arrived:
+                        with self._lock:
+                            self.shared += 1
+                        return rec['result']
+                except (IOError, OSError, ValueError, KeyError):
+                    pass
+
+                result = func()
+                try:
+                    with open(fname + '.tmp', 'w') as result_file:
+                        json.dump({'key': key, 'finished': time.time(), 'result': result}, result_file)
+                    os.rename(fname + '.tmp', fname + '.json')
+                except (IOError, OSError, TypeError, ValueError) as exception:
+                    log.debug('single-flight result of "{}" is not saved: {}'.format(key, exception))
+                return result
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'shared': self.shared,
+                    'in_flight': sorted(self._flights)}
+
+
+class ProcessPool(object):
+    """
+    Small pool of worker processes for the CPU-heavy post-processing
+    (parsing, diffing, license analytics), so it does not block the other
+    jobs of the proxy. At most max_pending tasks are queued, the callers
+    wait for a free slot. The functions and their arguments must be
+    picklable (module level functions of mod_utils).
+
+    If the pool cannot be used (e.g. the process is not allowed to have
+    children), the tasks are run in the calling process.
+    """
+
+    def __init__(self, processes=2, max_pending=4, timeout=300):
+        self.processes = int(processes)
+        self.timeout = float(timeout)
+        self.disabled = False
+        self.submitted = 0
+        self.inline = 0
+        self._pool = None
+        self._slots = threading.BoundedSemaphore(int(max_pending))
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None and not self.disabled:
+                try:
+                    self._pool = multiprocessing.Pool(self.processes)
+                except (AssertionError, OSError) as exception:
+                    log.warning('process pool is not available, running the tasks inline: {}'.format(exception))
+                    self.disabled = True
+            return self._pool
+
+    def run(self, func, *args):
+        """
+        Run func(*args) in a worker process and return its result
+        """
+        pool = self._get_pool()
+        if pool is None:
+            self.inline += 1
+            return func(*args)
+        with self._slots:
+            self.submitted += 1
+            return pool.apply_async(func, args).get(self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+
+    def stats(self):
+        return {'processes': self.processes,
+                'disabled': self.disabled,
+                'submitted': self.submitted,
+                'inline': self.inline}
+
+
+# The process pool of the proxy process, see offload()
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+
+# Default min_size of offload() per function: the license analytics of a
+# device take tens of records, the snapshots thousands of lines
+OFFLOAD_MIN_SIZE = {'license_records': 20}
+
+
+def offload(opts, pillar, size, func, *args):
+    """
+    Run func(*args) in the process pool if the input is big enough,
+    in the calling process otherwise (the transfer of a small input
+    costs more than the work). The pool is configured in the component pillar:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            process_pool:
+              enabled: true
+              processes: 2
+              max_pending: 4     # queued tasks, the callers wait for a slot
+              min_size: 2000     # lines/entries/records to offload (default: 20 license
+                                 # records, 2000 otherwise); or {<function name>: size}
+              timeout: 300
+
+    The pool is used only by the long-lived proxy process ("multiprocessing:
+    False"): with multiprocessing every job is a process of its own which
+    does not block the other jobs, and a pool per job would cost more than
+    the work.
+
+    Input:
+      * size - size of the input: lines of the output, entries of the snapshot, etc.
+    """
+    global _process_pool
+    if opts.get('multiprocessing', True):
+        return func(*args)
+    try:
+        config = device_profile(pillar).config.get('process_pool') or {}
+    except (KeyError, TypeError, AttributeError):
+        config = {}
+    min_size = config.get('min_size')
+    if isinstance(min_size, dict):
+        min_size = min_size.get(func.__name__)
+    if min_size is None:
+        min_size = OFFLOAD_MIN_SIZE.get(func.__name__, 2000)
+    if not config.get('enabled', True) or size < min_size:
+        return func(*args)
+
+    with _process_pool_lock:
+        if _process_pool is None:
+            _process_pool = ProcessPool(config.get('processes', 2), config.get('max_pending', 4),
+                                        config.get('timeout', 300))
+        pool = _process_pool
+    return pool.run(func, *args)
+
+
+def close_process_pool():
+    """
+    Terminate the worker processes of the pool
+    """
+    if _process_pool is not None:
+        _process_pool.close()
+
+
+def process_pool_stats():
+    """
+    Stats of the process pool, None if it was not used
+    """
+    return _process_pool.stats() if _process_pool is not None else None
+
+
+# =========================================================
+#                L I C E N S E   T A B L E
+# =========================================================
+
+# Default expiry threshold buckets, days
+LICENSE_THRESHOLDS = (7, 30, 90)
+
+
+def license_records(licenses, thresholds=LICENSE_THRESHOLDS, vendors=None, today=None, ordered=True):
+    """
+    Build the license table from the 'licenses' list of sys_info in one pass
+
+    Input:
+      * licenses   - [{'vendor': ..., 'valid': ..., 'days_remaining': ...}, ...]
+      * thresholds - expiry threshold buckets, days
+      * vendors    - vendor names to keep (default: None - all)
+      * today      - datetime.date to count the expiry date from (default: today)
+      * ordered    - sort the records by days_remaining (default: True),
+                     keep the order of the licenses otherwise
+    Output:
+      * list of records sorted by days_remaining:
+        {'vendor': 'BASE',
+         'valid': True,
+         'days_remaining': 25,
+         'expires': '2017-11-17',
+         'expired': False,
+         'bucket': 30,                        # smallest threshold the license expires within, or None
+         'within': {'7': False, '30': True, '90': True}}
+        The keys of "within" are strings, so the records are the same
+        after a JSON round trip (Salt returns, single-flight results)
+    """
+    thresholds = sorted(int(days) for days in thresholds)
+    today = today or datetime.date.today()
+    records = []
+
+    for license_dict in licenses:
+        vendor = license_dict.get('vendor')
+        if vendors is not None and vendor not in vendors:
+            continue
+        try:
+            days = int(license_dict.get('days_remaining'))
+        except (TypeError, ValueError):
+            days = None
+        valid = bool(license_dict.get('valid'))
+
+        within = dict((str(threshold), days is None or days <= threshold) for threshold in thresholds)
+        bucket = None
+        for threshold in thresholds:
+            if within[str(threshold)]:
+                bucket = threshold
+                break
+
+        records.append({'vendor': vendor,
+                        'valid': valid,
+                        'days_remaining': days,
+                        'expires': (today + datetime.timedelta(days=days)).isoformat() if days is not None else None,
+                        'expired': not valid or days is None or days <= 0,
+                        'bucket': bucket,
+                        'within': within})
+
+    if ordered:
+        records.sort(key=lambda rec: (rec['days_remaining'] is not None, rec['days_remaining']))
+    return records
+
+
+# =========================================================
+#             R U N N I N G - C O N F I G   S N A P S H O T
+# =========================================================
+
+# Tokens which start the value of a configuration line
+_VALUE_TOKENS = ('true', 'false', 'enabled', 'disabled')
+
+
+def split_config_line(tokens):
+    """
+    Split the tokens of a configuration line (or command) into (key, value).
+    The value starts at the first token which looks like a value: a number,
+    an address, a boolean, a list "[ ... ]" or a quoted string.
+      services clam active true                 -> ('services clam active', 'true')
+      ip-address 172.27.178.85 255.255.255.0    -> ('ip-address', '172.27.178.85 255.255.255.0')
+      alerts destinations snmp [ ]              -> ('alerts destinations snmp', '[ ]')
+    """
+    for idx, token in enumerate(tokens):
+        if idx == 0:
+            continue
+        if token[0] in '["\'' or token.lower() in _VALUE_TOKENS or any(char.isdigit() for char in token):
+            return ' '.join(tokens[:idx]), ' '.join(tokens[idx:])
+    return ' '.join(tokens), ''
+
+
+class ConfigSnapshot(object):
+    """
+    Parsed "show running-config" output stored as a sorted array of
+    (path, value) tuples:
+
+    .. code-block:: text
+
+        interface 1:0                              ('interface 1:0', '')
+         ip-address 172.27.178.85 255.255.255.0 -> ('interface 1:0 ip-address', '172.27.178.85 255.255.255.0')
+        !
+        services clam active true                  ('services clam active', 'true')
+
+    * lookup(prefix) - all the entries of the subtree in O(log n + k)
+    * values(path)   - the values of one path (a path may repeat, e.g. list entries)
+    * to_dict()/from_dict(), save()/load() - JSON serialization
+    """
+
+    def __init__(self, entries=(), timestamp=None):
+        self.entries = sorted(entries)
+        self.paths = [path for path, value in self.entries]
+        self.timestamp = timestamp if timestamp is not None else time.time()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def parse(cls, text, timestamp=None):
+        """
+        Parse the running-config text (or its lines, see iter_lines).
+        Blocks are defined by the indentation, "!" lines close the blocks
+        and are skipped.
+        """
+        lines = []
+        for line in (text.splitlines() if isinstance(text, _STRING_TYPES) else text):
+            stripped = line.strip()
+            if not stripped or stripped == '!' or stripped.startswith('%'):
+                continue
+            lines.append((len(line) - len(line.lstrip()), stripped.split()))
+
+        entries = []
+        parents = []  # [(indent, path)]
+        for idx, (indent, tokens) in enumerate(lines):
+            while parents and parents[-1][0] >= indent:
+                parents.pop()
+            prefix = parents[-1][1] + ' ' if parents else ''
+            is_block = idx + 1 < len(lines) and lines[idx + 1][0] > indent
+            if is_block:
+                path = prefix + ' '.join(tokens)
+                entries.append((path, ''))
+                parents.append((indent, path))
+            else:
+                key, value = split_config_line(tokens)
+                entries.append((prefix + key, value))
+        return cls(entries, timestamp)
+
+    def lookup(self, prefix):
+        """
+        All the (path, value) entries of the path and its subtree
+        """
+        prefix = ' '.join(prefix.split())
+        res = []
+        idx = bisect.bisect_left(self.paths, prefix)
+        while idx < len(self.paths) and self.paths[idx].startswith(prefix):
+            path = self.paths[idx]
+            if len(path) == len(prefix) or path[len(prefix)] == ' ':
+                res.append(self.entries[idx])
+            idx += 1
+        return res
+
+    def values(self, path):
+        """
+        The values of the path, [] if the path is not configured
+        """
+        path = ' '.join(path.split())
+        lo = bisect.bisect_left(self.paths, path)
+        hi = bisect.bisect_right(self.paths, path)
+        return [value for _, value in self.entries[lo:hi]]
+
+    def as_dict(self):
+        """
+        {path: value}, the values of a repeated path are joined with ", "
+        """
+        res = {}
+        for path, value in self.entries:
+            res[path] = res[path] + ', ' + value if path in res else value
+        return res
+
+    def to_dict(self):
+        return {'timestamp': self.timestamp, 'entries': self.entries}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls([tuple(entry) for entry in data['entries']], data.get('timestamp'))
+
+    def save(self, fname):
+        """
+        Save the snapshot to JSON file atomically
+        """
+        dirname = os.path.dirname(fname)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmp_fname = '{0}.{1}.tmp'.format(fname, os.getpid())
+        with open(tmp_fname, 'w') as out_file:
+            json.dump(self.to_dict(), out_file)
+        os.rename(tmp_fname, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'r') as in_file:
+            return cls.from_dict(json.load(in_file))
+
+
+def snapshot_dir(opts, pillar):
+    """
+    Directory of the running-config snapshots of the device:
+      <cachedir>/mod/snapshots/<comp>-<pod>
+    """
+    return os.path.join(opts.get('cachedir', '/var/cache/salt/proxy'), 'mod', 'snapshots', device_name(pillar))
+
+
+def save_snapshot(opts, pillar, snapshot, keep=10):
+    """
+    Save the snapshot of the device, keep the last <keep> snapshots
+    Output:
+      * file name of the snapshot
+    """
+    dirname = snapshot_dir(opts, pillar)
+    fname = os.path.join(dirname, '{0:.3f}.json'.format(snapshot.timestamp))
+    snapshot.save(fname)
+    for old_fname in list_snapshots(opts, pillar)[:-keep]:
+        os.remove(old_fname)
+    return fname
+
+
+def list_snapshots(opts, pillar):
+    """
+    File names of the stored snapshots of the device, the oldest first
+    """
+    dirname = snapshot_dir(opts, pillar)
+    if not os.path.isdir(dirname):
+        return []
+    fnames = [fname for fname in os.listdir(dirname) if fname.endswith('.json')]
+    return [os.path.join(dirname, fname) for fname in sorted(fnames, key=lambda fname: float(fname[:-5]))]
+
+
+def load_snapshot(opts, pillar, index=-1):
+    """
+    Load the stored snapshot of the device (default: the last one), or None
+    """
+    fnames = list_snapshots(opts, pillar)
+    try:
+        return ConfigSnapshot.load(fnames[index])
+    except IndexError:
+        return None
+
+
+def parse_snapshot(lines, timestamp=None):
+    """
+    ConfigSnapshot.parse() as a module level function (for offload())
+    """
+    return ConfigSnapshot.parse(lines, timestamp)
+
+
+def diff_snapshots(old, new):
+    """
+    Diff two snapshots
+    Output:
+      * {'added': {path: value}, 'removed': {path: value}, 'changed': {path: {'old': ..., 'new': ...}}}
+    """
+    old_dict = old.as_dict() if old is not None else {}
+    new_dict = new.as_dict()
+    res = {'added': {}, 'removed': {}, 'changed': {}}
+    for path, value in new_dict.items():
+        if path not in old_dict:
+            res['added'][path] = value
+        elif old_dict[path] != value:
+            res['changed'][path] = {'old': old_dict[path], 'new': value}
+    for path, value in old_dict.items():
+        if path not in new_dict:
+            res['removed'][path] = value
+    return res
+
+
+def desired_config(commands):
+    """
+    Turn the configuration commands into {path: value} comparable with the
+    snapshot. The commands without a recognized value (actions like
+    "ntp update-now", string values like "hostname foo") cannot be compared
+    and are skipped, see uncompared_commands().
+    """
+    res = {}
+    for cmd in commands:
+        if 'http' not in cmd:
+            cmd = cmd.replace('/', ' ')
+        path, value = split_config_line(cmd.split())
+        if value:
+            res[path] = res[path] + ', ' + value if path in res else value
+    return res
+
+
+def uncompared_commands(commands):
+    """
+    The configuration commands which desired_config() cannot compare with
+    the snapshot: no token looks like a value (see split_config_line), e.g.
+    actions like "ntp update-now", but also string-valued settings like
+    "hostname foo" or "mode active". Report them to the callers, so they
+    are not mistaken for settings without drift.
+    """
+    res = []
+    for cmd in commands:
+        tokens = (cmd if 'http' in cmd else cmd.replace('/', ' ')).split()
+        if not split_config_line(tokens)[1]:
+            res.append(cmd)
+    return res
+
+
+def diff_desired(snapshot, desired):
+    """
+    Diff the desired {path: value} against the snapshot
+    Output:
+      * {'missing': {path: desired value}, 'changed': {path: {'old': ..., 'new': ...}}}
+    """
+    current = snapshot.as_dict()
+    res = {'missing': {}, 'changed': {}}
+    for path, value in desired.items():
+        if path not in current:
+            res['missing'][path] = value
+        elif ' '.join(current[path].split()) != ' '.join(value.split()):
+            res['changed'][path] = {'old': current[path], 'new': value}
+    return res
+
+
+# =========================================================
+#              S T R E A M E D   O U T P U T
+# =========================================================
+
+try:
+    _STRING_TYPES = (str, unicode)  # pylint: disable=undefined-variable
+except NameError:
+    _STRING_TYPES = (str, bytes)
+
+
+def iter_lines(chunks):
+    """
+    Split the command output into lines lazily.
+
+    Input:
+      * chunks - the whole output (string) or an iterable of output
+                 chunks as they arrive from the device
+    Output:
+      * generator of the lines without the line endings
+    """
+    if isinstance(chunks, _STRING_TYPES):
+        chunks = (chunks,)
+    pending = ''
+    for chunk in chunks:
+        start = 0
+        end = chunk.find('\n')
+        while end >= 0:
+            yield pending + chunk[start:end].rstrip('\r')
+            pending = ''
+            start = end + 1
+            end = chunk.find('\n', start)
+        pending += chunk[start:]
+    if pending:
+        yield pending
+
+
+def find_in_lines(lines, check, keep=50):
+    """
+    Case-insensitive search of the check text in the output lines,
+    stops reading the output at the first matching line.
+
+    Output:
+      * (True, matching line) if found,
+        (False, the last "keep" lines of the output) otherwise
+    """
+    check = check.lower()
+    tail = []
+    for line in lines:
+        if check in line.lower():
+            return True, line
+        tail.append(line)
+        if len(tail) > keep:
+            del tail[0]
+    return False, '\n'.join(tail)
+
+
+def read_until(lines, expect):
+    """
+    Read the output lines up to the first line matching one of the expected
+    patterns: plain text (case-sensitive) or compiled regular expressions.
+
+    Output:
+      * (index of the matched pattern or None, the lines read joined with '\n')
+    """
+    read = []
+    for line in lines:
+        read.append(line)
+        for idx, pattern in enumerate(expect):
+            if (pattern.search(line) if hasattr(pattern, 'search') else pattern in line):
+                return idx, '\n'.join(read)
+    return None, '\n'.join(read)
+
+
+# =========================================================
+#                    P R O F I L I N G
+# =========================================================
+
+class Profile(object):
+    """
+    Profile of one run: cProfile of the calling thread (optional) plus the
+    trace of the nested spans (state and module functions, CLI/REST/subprocess
+    calls, logins, sleeps) of the process
+    """
+
+    def __init__(self, name, directory, cprofile=True):
+        self.name = name
+        self.directory = directory
+        self.started = time.time()
+        self.trace_id = '{:032x}'.format(random.getrandbits(128))
+        self.spans = []
+        self.profiler = cProfile.Profile() if cprofile else None
+        self._lock = threading.Lock()
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def summary(self):
+        """
+        Count, total and self seconds (without the child spans) of the spans by kind
+        """
+        with self._lock:
+            spans = list(self.spans)
+        children = {}
+        for span in spans:
+            if span['parent_id']:
+                children[span['parent_id']] = children.get(span['parent_id'], 0.0) + span['duration']
+        res = {}
+        for span in spans:
+            rec = res.setdefault(span['kind'], {'count': 0, 'seconds': 0.0, 'self_seconds': 0.0})
+            rec['count'] += 1
+            rec['seconds'] = round(rec['seconds'] + span['duration'], 3)
+            rec['self_seconds'] = round(rec['self_seconds'] + max(0.0, span['duration'] - children.get(span['span_id'], 0.0)), 3)
+        return res
+
+    def otlp(self, service='salt-mod-proxy'):
+        """
+        The spans in the OTLP/JSON format (ExportTraceServiceRequest)
+        """
+        def value(item):
+            if isinstance(item, bool):
+                return {'boolValue': item}
+            if isinstance(item, int):
+                return {'intValue': str(item)}
+            if isinstance(item, float):
+                return {'doubleValue': item}
+            return {'stringValue': str(item)}
+
+        spans = []
+        with self._lock:
+            for span in self.spans:
+                start = self.started + span['start']
+                attrs = dict((key, item) for key, item in span.items()
+                             if key not in ('kind', 'name', 'start', 'duration', 'span_id', 'parent_id', 'error')
+                             and item is not None)
+                attrs['mod.kind'] = span['kind']
+                spans.append({'traceId': self.trace_id,
+                              'spanId': span['span_id'],
+                              'parentSpanId': span['parent_id'] or '',
+                              'name': span['name'],
+                              # CLIENT for the calls to the device, INTERNAL otherwise
+                              'kind': 3 if span['kind'] in ('cli', 'rest', 'login', 'subprocess') else 1,
+                              'startTimeUnixNano': str(int(start * 1e9)),
+                              'endTimeUnixNano': str(int((start + span['duration']) * 1e9)),
+                              'attributes': [{'key': key, 'value': value(item)} for key, item in sorted(attrs.items())],
+                              'status': {'code': 2, 'message': span['error']} if span['error'] else {'code': 1}})
+        return {'resourceSpans': [{'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': service}},
+                                                               {'key': 'mod.run', 'value': {'stringValue': self.name}}]},
+                                   'scopeSpans': [{'scope': {'name': 'mod_utils'}, 'spans': spans}]}]}
+
+
+# The profile of the running job, see start_profile()
+_active_profile = None
+_active_profile_lock = threading.Lock()
+
+# The stack of the open spans of every thread
+_span_stack = threading.local()
+
+
+def start_profile(name, directory, cprofile=True):
+    """
+    Start profiling; None if a profile is already running in the process
+    """
+    global _active_profile
+    with _active_profile_lock:
+        if _active_profile is not None:
+            return None
+        _active_profile = Profile(name, directory, cprofile)
+    if _active_profile.profiler is not None:
+        _active_profile.profiler.enable()
+    return _active_profile
+
+
+def stop_profile(profile):
+    """
+    Stop profiling and write the files of the profile:
+      <directory>/<name>-<timestamp>.prof           - cProfile (pstats) data
+      <directory>/<name>-<timestamp>.timeline.json  - the spans
+      <directory>/<name>-<timestamp>.otlp.json      - the spans in the OTLP/JSON format
+    Output:
+      * {'profile': <file or None>, 'timeline': <file>, 'otlp': <file>, 'trace_id': ..., 'seconds': N,
+         'spans': {kind: {'count', 'seconds', 'self_seconds'}}}
+    """
+    global _active_profile
+    if profile.profiler is not None:
+        profile.profiler.disable()
+    with _active_profile_lock:
+        if _active_profile is profile:
+            _active_profile = None
+
+    if not os.path.isdir(profile.directory):
+        os.makedirs(profile.directory)
+    base = os.path.join(profile.directory, '{}-{}'.format(
+        ''.join(c if c.isalnum() or c in '-_.' else '_' for c in profile.name),
+        datetime.datetime.fromtimestamp(profile.started).strftime('%Y%m%d-%H%M%S')))
+    if profile.profiler is not None:
+        profile.profiler.dump_stats(base + '.prof')
+    seconds = round(time.time() - profile.started, 3)
+    with open(base + '.timeline.json', 'w') as out_file:
+        json.dump({'name': profile.name, 'trace_id': profile.trace_id, 'started': profile.started,
+                   'seconds': seconds, 'spans': profile.spans}, out_file, indent=1, default=str)
+    with open(base + '.otlp.json', 'w') as out_file:
+        json.dump(profile.otlp(), out_file, default=str)
+    return {'profile': base + '.prof' if profile.profiler is not None else None,
+            'timeline': base + '.timeline.json',
+            'otlp': base + '.otlp.json',
+            'trace_id': profile.trace_id,
+            'seconds': seconds,
+            'spans': profile.summary()}
+
+
+def profile_config(pillar):
+    """
+    The "profile" settings of the component pillar:
+
+    .. code-block:: yaml
+
+      pod:
+        mod:
+          <comp_name>:
+            profile:
+              enabled: true
+              cprofile: false                          # trace only (default: true)
+              dir: /var/cache/salt/proxy/mod/profile   # default: <cachedir>/mod/profile
+    """
+    try:
+        return device_profile(pillar).config.get('profile') or {}
+    except (KeyError, TypeError, AttributeError):
+        return {}
+
+
+def profile_dir(opts, pillar):
+    """
+    Directory of the profile files
+    """
+    return profile_config(pillar).get('dir') or os.path.join(opts.get('cachedir', '/var/cache/salt/proxy'), 'mod', 'profile')
+
+
+class span(object):
+    """
+    Span of the trace: a function, device call, login, sleep, etc.
+    The spans opened inside the "with" block of the span in the same thread
+    are its children. Recorded only while a profile is running.
+
+    .. code-block:: python
+
+        with mod_utils.span('cli', command):
+            output = session.command(command, context)
+    """
+
+    def __init__(self, kind, name, **attrs):
+        self.kind = kind
+        self.name = name
+        self.attrs = attrs
+        self.profile = None
+        self.start = None
+        self.span_id = None
+        self.parent_id = None
+
+    def __enter__(self):
+        self.profile = _active_profile
+        if self.profile is not None:
+            stack = _span_stack.__dict__.setdefault('spans', [])
+            self.parent_id = stack[-1].span_id if stack and stack[-1].profile is self.profile else None
+            self.span_id = '{:016x}'.format(random.getrandbits(64))
+            stack.append(self)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.profile is not None:
+            duration = time.time() - self.start
+            stack = _span_stack.spans
+            if stack and stack[-1] is self:
+                stack.pop()
+            rec = {'kind': self.kind,
+                   'name': self.name,
+                   'span_id': self.span_id,
+                   'parent_id': self.parent_id,
+                   'start': round(self.start - self.profile.started, 6),
+                   'duration': round(duration, 6),
+                   'thread': threading.current_thread().name,
+                   'error': str(exc_value) if exc_value is not None else None}
+            rec.update(self.attrs)
+            self.profile.add(rec)
+        return False
+
+
+def sleep(seconds, name='sleep'):
+    """
+    time.sleep() recorded as a span of the trace
+    """
+    with span('sleep', name, seconds=seconds):
+        time.sleep(seconds)